@@ -0,0 +1,79 @@
+import collections
+import logging
+import p9admin.trace
+
+logger = logging.getLogger(__name__)
+
+Access = collections.namedtuple("Access", ["role", "via"])
+
+class AccessMatrix(object):
+    """
+    Which users have which roles on which projects
+
+    Indexed both ways: by_user[user_id][project_id] and
+    by_project[project_id][user_id] are sets of Access(role name, via), where
+    via is None for a direct assignment or the name of the group that grants
+    it.
+    """
+
+    def __init__(self):
+        self.by_user = collections.defaultdict(lambda: collections.defaultdict(set))
+        self.by_project = collections.defaultdict(lambda: collections.defaultdict(set))
+        self.user_names = {}
+        self.project_names = {}
+
+    def add(self, user, project, role, via=None):
+        access = Access(role["name"], via)
+        self.by_user[user["id"]][project["id"]].add(access)
+        self.by_project[project["id"]][user["id"]].add(access)
+        self.user_names[user["id"]] = user["name"]
+        self.project_names[project["id"]] = project["name"]
+
+    def rows(self, by="user"):
+        """
+        Yield (user_id, project_id, [Access]) sorted by user or project name
+        """
+        if by == "user":
+            for user_id in sorted(self.by_user, key=self.user_names.get):
+                projects = self.by_user[user_id]
+                for project_id in sorted(projects, key=self.project_names.get):
+                    yield user_id, project_id, sorted(projects[project_id], key=str)
+        elif by == "project":
+            for project_id in sorted(self.by_project, key=self.project_names.get):
+                users = self.by_project[project_id]
+                for user_id in sorted(users, key=self.user_names.get):
+                    yield user_id, project_id, sorted(users[user_id], key=str)
+        else:
+            raise ValueError("by must be user or project")
+
+@p9admin.trace.traced
+def access_matrix(client):
+    """
+    Build an AccessMatrix for every project from one role assignment listing
+
+    Group assignments are expanded by fetching each group's members once, no
+    matter how many projects the group is assigned to.
+    """
+    matrix = AccessMatrix()
+    group_assignments = []
+
+    assignments = client.keystone().role_assignments.list(include_names=True)
+    for assignment in assignments:
+        project = assignment.scope.get("project")
+        if project is None:
+            continue
+        if hasattr(assignment, "user"):
+            matrix.add(assignment.user, project, assignment.role)
+        elif hasattr(assignment, "group"):
+            group_assignments.append(assignment)
+
+    logger.info("Retrieved %d role assignments, %d for groups",
+        len(assignments), len(group_assignments))
+
+    for assignment in group_assignments:
+        group = assignment.group
+        for user in client.group_members(group["id"]):
+            matrix.add({"id": user.id, "name": user.name},
+                assignment.scope["project"], assignment.role, via=group["name"])
+
+    return matrix
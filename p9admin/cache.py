@@ -0,0 +1,42 @@
+import json
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+def cache_dir():
+    """
+    Directory for state kept between runs
+
+    Defaults to ~/.cache/p9-admin. Set P9ADMIN_CACHE_DIR to override.
+    """
+    return os.environ.get("P9ADMIN_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "p9-admin"))
+
+def cache_path(name):
+    return os.path.join(cache_dir(), name)
+
+def load_json(name):
+    """Load a JSON cache file, or return None if it's missing or unreadable"""
+    path = cache_path(name)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError):
+        return None
+    except ValueError as e:
+        logger.warning('Ignoring corrupt cache file "%s": %s', path, e)
+        return None
+
+def save_json(name, data):
+    """Atomically replace a JSON cache file"""
+    path = cache_path(name)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=name)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        logger.warning('Could not save cache file "%s": %s', path, e)
@@ -1,7 +1,13 @@
+import atexit
 import click
+import json
 import logging
+import logging.handlers
 import openstack
 import p9admin
+import p9admin.trace
+import p9admin.wire
+import queue
 import sys
 
 def add_command_group(module):
@@ -10,21 +16,54 @@ def add_command_group(module):
         if object.__class__ == click.core.Group:
             cli.add_command(object)
 
-def set_up_logging(level=logging.WARNING):
+class JSONFormatter(logging.Formatter):
+    """Format log records as single-line JSON objects"""
+
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "name": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+def set_up_logging(level=logging.WARNING, json_path=None):
+    """
+    Send log messages to a background thread for writing
+
+    Human readable messages go to stderr so they don't mix with output on
+    stdout. If json_path is set, messages are also written there as JSON lines.
+    """
     logging.captureWarnings(True)
 
     format = "%(relativeCreated)7d %(name)s: %(message)s"
 
-    handler = logging.StreamHandler(stream=sys.stdout)
+    handler = logging.StreamHandler(stream=sys.stderr)
     try:
         import colorlog
         handler.setFormatter(colorlog.ColoredFormatter("%(log_color)s" + format))
     except ImportError:
         handler.setFormatter(logging.Formatter(format))
+    handlers = [handler]
+
+    if json_path:
+        json_handler = logging.FileHandler(json_path)
+        json_handler.setFormatter(JSONFormatter())
+        handlers.append(json_handler)
+
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, *handlers,
+        respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
 
     root = logging.getLogger()
     root.setLevel(level)
-    root.addHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
 
 def main():
     try:
@@ -39,21 +78,49 @@ def main():
 @click.option("--verbose", "-v", default=False, is_flag=True)
 @click.option("--debug", "-d", default=False, is_flag=True)
 @click.option("--openstack-debug", default=False, is_flag=True)
+@click.option("--log-json", metavar="FILE",
+    help="Also write log messages to FILE as JSON lines.")
+@click.option("--trace", "trace_path", metavar="FILE",
+    help="Write a timeline of the command to FILE in Chrome trace format.")
+@click.option("--inventory", default="auto",
+    type=click.Choice(p9admin.client.INVENTORY_STRATEGIES),
+    help="How to list servers and volumes for individual projects: scan the "
+        "whole cloud once, filter on the server per project, or choose "
+        "automatically (the default).")
+@click.option("--compare-projection", default=False, is_flag=True,
+    help="Also download full Neutron listings to show, with --verbose, how "
+        "much requesting only the needed fields saves. Slower.")
 @click.version_option()
-def cli(verbose, debug, openstack_debug):
+@click.pass_context
+def cli(ctx, verbose, debug, openstack_debug, log_json, trace_path, inventory,
+        compare_projection):
+    p9admin.client.OpenStackClient.inventory_strategy = inventory
+    p9admin.wire.compare_projection = compare_projection
+
     if debug:
-        set_up_logging(logging.INFO)
+        set_up_logging(logging.INFO, log_json)
         openstack.enable_logging()
         logging.getLogger("p9admin").setLevel(logging.DEBUG)
     elif verbose:
-        set_up_logging(logging.INFO)
+        set_up_logging(logging.INFO, log_json)
         openstack.enable_logging()
     else:
-        set_up_logging(logging.WARNING)
+        set_up_logging(logging.WARNING, log_json)
 
     if openstack_debug:
         openstack.enable_logging(debug=True, http_debug=True)
 
+    # Shown with --verbose.
+    ctx.call_on_close(p9admin.wire.report)
+
+    if trace_path:
+        p9admin.trace.enable()
+        # Resources are cleaned up in reverse order, so the file is written
+        # after the command span is recorded.
+        ctx.call_on_close(lambda: p9admin.trace.write(trace_path))
+        ctx.with_resource(p9admin.trace.span(
+            "p9-admin {}".format(ctx.invoked_subcommand), "command"))
+
 @cli.command("repl")
 def repl():
     """
@@ -70,11 +137,13 @@ def repl():
 
 import p9admin.cli.host
 import p9admin.cli.image
+import p9admin.cli.network
 import p9admin.cli.project
 import p9admin.cli.user
 
 add_command_group(host)
 add_command_group(image)
+add_command_group(network)
 add_command_group(project)
 add_command_group(user)
 
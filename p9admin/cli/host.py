@@ -3,6 +3,8 @@ import click
 import csv
 import operator
 import p9admin
+import p9admin.host
+import p9admin.regions
 import sys
 
 @click.group()
@@ -10,28 +12,158 @@ def host():
     """Tools for hypervisors."""
     pass
 
+def _host_row(host):
+    return [
+        host['OS-EXT-PF9-HYP-ATTR:host_id'],
+        host['hypervisor_hostname'],
+        host['state'],
+        host['status'],
+    ]
+
 @host.command()
 @click.option("--format", "-f", default="table")
-def list(format):
+@click.option("--regions", "-r", multiple=True, metavar="REGION[,REGION]",
+    callback=p9admin.regions.parse_regions,
+    help="Query several regions concurrently and add a region column.")
+def list(format, regions):
     """List hosts."""
-    hosts = p9admin.OpenStackClient().openstack().list_hypervisors()
-    hosts = sorted(hosts, key=operator.itemgetter("hypervisor_hostname"))
+    if format not in ("csv", "table"):
+        sys.exit("Format must be csv or table")
+
+    client = p9admin.OpenStackClient()
+    if regions:
+        def region_hosts(client):
+            hosts = client.openstack().list_hypervisors()
+            return sorted(hosts, key=operator.itemgetter("hypervisor_hostname"))
+        rows = p9admin.regions.fan_out(client, regions, region_hosts)
+    else:
+        hosts = client.openstack().list_hypervisors()
+        hosts = sorted(hosts, key=operator.itemgetter("hypervisor_hostname"))
+        rows = [(None, host) for host in hosts]
 
     if format == "csv":
         writer = csv.writer(sys.stdout)
-        writer.writerow(["host_id", "hostname", "state", "status"])
-        for host in hosts:
-            writer.writerow([
-                host['OS-EXT-PF9-HYP-ATTR:host_id'],
-                host['hypervisor_hostname'],
-                host['state'],
-                host['status'],
-            ])
+        header = ["host_id", "hostname", "state", "status"]
+        if regions:
+            header = ["region"] + header
+        writer.writerow(header)
+        for region, host in rows:
+            if regions:
+                writer.writerow([region] + _host_row(host))
+            else:
+                writer.writerow(_host_row(host))
     elif format == "table":
-        for host in hosts:
+        for region, host in rows:
+            if regions:
+                print("{:<15} ".format(region), end="")
             print("{host_id}  {hypervisor_hostname:<55} {state:10} {status:10}" \
                 .format(
                     host_id=host['OS-EXT-PF9-HYP-ATTR:host_id'],
                     **host.toDict()))
+
+
+def _ratio(ratio):
+    if ratio is None:
+        return ""
+    return "{:.2f}".format(ratio)
+
+@host.command()
+@click.option("--format", "-f", default="table")
+@click.option("--cpu-ratio", type=float,
+    default=p9admin.host.DEFAULT_RATIOS["vcpus"], show_default=True,
+    help="Flag hosts with more vCPUs allocated per physical CPU.")
+@click.option("--ram-ratio", type=float,
+    default=p9admin.host.DEFAULT_RATIOS["ram"], show_default=True,
+    help="Flag hosts with more RAM allocated per physical MB.")
+@click.option("--disk-ratio", type=float,
+    default=p9admin.host.DEFAULT_RATIOS["disk"], show_default=True,
+    help="Flag hosts with more disk allocated per physical GB.")
+def capacity(format, cpu_ratio, ram_ratio, disk_ratio):
+    """
+    Show allocated and physical resources per host.
+
+    Allocation is the sum of the flavors of the servers on each host. Hosts
+    whose allocation ratio for any resource exceeds the limit are flagged.
+    """
+    limits = {"vcpus": cpu_ratio, "ram": ram_ratio, "disk": disk_ratio}
+    client = p9admin.OpenStackClient()
+    hosts = p9admin.host.get_capacity(client)
+    fleet = p9admin.host.fleet_capacity(hosts)
+
+    if format == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["host", "servers",
+            "vcpus_allocated", "vcpus", "vcpus_ratio",
+            "ram_allocated", "ram", "ram_ratio",
+            "disk_allocated", "disk", "disk_ratio",
+            "overcommitted"])
+        for host in hosts + [fleet]:
+            columns = zip(host.allocated, host.physical,
+                map(_ratio, p9admin.host.ratios(host)))
+            writer.writerow([host.name, host.servers]
+                + [value for column in columns for value in column]
+                + [" ".join(p9admin.host.overcommitted(host, limits))])
+    elif format == "table":
+        print("{:<55} {:>7} {:>15} {:>21} {:>17}  {}".format(
+            "host", "servers", "vcpus", "ram (MB)", "disk (GB)", ""))
+        for host in hosts + [fleet]:
+            columns = ["{}/{} {:>6}".format(a, p, _ratio(r)) for a, p, r
+                in zip(host.allocated, host.physical, p9admin.host.ratios(host))]
+            flagged = p9admin.host.overcommitted(host, limits)
+            print("{:<55} {:>7} {:>15} {:>21} {:>17}  {}".format(
+                host.name, host.servers, *columns,
+                "OVERCOMMITTED " + ",".join(flagged) if flagged else ""))
     else:
         sys.exit("Format must be csv or table")
+
+
+@host.command("drain-plan")
+@click.argument("hosts", metavar="HOST [HOST ...]", nargs=-1, required=True)
+@click.option("--format", "-f", default="table")
+@click.option("--cpu-ratio", type=float,
+    default=p9admin.host.DEFAULT_RATIOS["vcpus"], show_default=True,
+    help="Maximum vCPUs allocated per physical CPU on target hosts.")
+@click.option("--ram-ratio", type=float,
+    default=p9admin.host.DEFAULT_RATIOS["ram"], show_default=True,
+    help="Maximum RAM allocated per physical MB on target hosts.")
+@click.option("--disk-ratio", type=float,
+    default=p9admin.host.DEFAULT_RATIOS["disk"], show_default=True,
+    help="Maximum disk allocated per physical GB on target hosts.")
+def drain_plan(hosts, format, cpu_ratio, ram_ratio, disk_ratio):
+    """
+    Plan where to move servers off of hosts.
+
+    HOST is the compute service host name, as shown by host capacity. This
+    only prints a plan; it doesn't migrate anything.
+    """
+    if format not in ("csv", "table"):
+        sys.exit("Format must be csv or table")
+
+    limits = {"vcpus": cpu_ratio, "ram": ram_ratio, "disk": disk_ratio}
+    client = p9admin.OpenStackClient()
+    try:
+        placements, unplaced = p9admin.host.plan_drain(client, hosts, limits)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    if format == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["server_id", "server_name", "vcpus", "ram", "disk",
+            "source", "target"])
+        for placement in placements + unplaced:
+            writer.writerow([placement.server.id, placement.server.name]
+                + placement.size + [placement.source, placement.target or ""])
+    else:
+        for placement in placements:
+            print('Server "{}" [{}] {}/{}/{}: {} -> {}'.format(
+                placement.server.name, placement.server.id,
+                *(placement.size + [placement.source, placement.target])))
+        for placement in unplaced:
+            print('Server "{}" [{}] {}/{}/{}: {} does not fit anywhere'.format(
+                placement.server.name, placement.server.id,
+                *(placement.size + [placement.source])))
+        print("{} servers placed, {} do not fit".format(
+            len(placements), len(unplaced)))
+
+    if unplaced:
+        sys.exit(1)
@@ -1,7 +1,9 @@
 from __future__ import print_function
 import click
+import csv
 import logging
 import p9admin
+import p9admin.image
 from pprint import pprint
 import sys
 
@@ -11,71 +13,238 @@ def image():
     pass
 
 
-def _fix_provider_location(logger, glance, image):
+FIXED = "fixed"
+UNCHANGED = "unchanged"
+UNMATCHED = "unmatched"
+FAILED = "failed"
+
+def _fix_provider_location(logger, glance, image, rules):
+    """Returns one of FIXED, UNCHANGED, UNMATCHED, or FAILED"""
     if len(image.locations) != 1:
         logger.error("Expected single location, got %s", image.locations)
-        return False
+        return FAILED
 
     location = image.locations[0]["url"]
     logger.debug('Image "%s" [%s] location: "%s"',
         image.name, image.id, location)
 
     try:
-        logger.debug('Image "%s" [%s] provider_location: "%s"',
-            image.name, image.id, image.provider_location)
+        current = image.provider_location
     except AttributeError:
-        logger.debug('Image "%s" [%s] provider_location: None',
-            image.name, image.id)
-
-    expected_prefix = "file:///var/opt/pf9/imagelibrary/data/"
-    tintri_prefix = "nfs://tintri-data-opdx-1-1.ops.puppetlabs.net:/tintri/p9openstack-prod/images/"
+        current = None
+    logger.debug('Image "%s" [%s] provider_location: "%s"',
+        image.name, image.id, current)
 
-    if not location.startswith(expected_prefix):
+    rule, provider_location = rules.rewrite(location)
+    if rule is None:
         logger.error(
-            'Image "%s" [%s]: expected location URL to start with "%s", got "%s"',
-            image.name, image.id, expected_prefix, location)
-        return False
+            'Image "%s" [%s]: no location rule matches "%s"',
+            image.name, image.id, location)
+        return UNMATCHED
 
-    relative_path = location[len(expected_prefix):]
-    provider_location = tintri_prefix + relative_path
+    if current == provider_location:
+        logger.debug('Image "%s" [%s] provider_location already correct',
+            image.name, image.id)
+        return UNCHANGED
 
     image = glance.images.update(image.id, provider_location=provider_location)
     logger.debug('Image "%s" [%s] provider_location saved as: "%s"',
         image.name, image.id, image.provider_location)
 
     if image.provider_location == provider_location:
-        logger.info('Fixed image "%s" [%s] provider_location',
-            image.name, image.id)
-        return True
+        logger.info('Fixed image "%s" [%s] provider_location with rule "%s"',
+            image.name, image.id, rule.name)
+        return FIXED
     else:
         logger.error('Image "%s" [%s] provider_location could not be saved',
             image.name, image.id)
-        return False
+        return FAILED
 
 
 @image.command("fix-provider-location")
 @click.argument("id", required=False)
 @click.option("--all/--one", default=False,
     help="Fix all images (don't specify an ID) or just one.")
-def fix_provider_location(id=None, all=False):
+@click.option("--rules", "rules_path", default="conf/locations.ini",
+    show_default=True, help="INI file of location rewrite rules.")
+def fix_provider_location(id=None, all=False, rules_path=None):
     """
     Fix the provider_location property of an image.
 
     Setting the provider_location property correctly allows the Tintri to do the
     clone of the image instead of having OpenStack download the image and then
     re-upload it via Cinder.
+
+    The provider_location is derived from the image location using the rules
+    in conf/locations.ini. Images that match no rule are listed at the end.
     """
     logger = logging.getLogger(__name__)
-    glance = p9admin.OpenStackClient().glance()
 
     if all and id is not None:
         sys.exit("ID and --all cannot both be specified.")
     if not all and id is None:
         sys.exit("Either ID or --all must be specified.")
 
+    rules = p9admin.image.LocationRules(
+        p9admin.image.load_location_rules(rules_path))
+    client = p9admin.OpenStackClient()
+    client.require_service("image")
+    glance = client.glance()
+
+    if all:
+        images = glance.images.list()
+    else:
+        images = [glance.images.get(id)]
+
+    counts = dict((status, 0) for status in (FIXED, UNCHANGED, UNMATCHED, FAILED))
+    unmatched = []
+    for image in images:
+        status = _fix_provider_location(logger, glance, image, rules)
+        counts[status] += 1
+        if status == UNMATCHED:
+            unmatched.append(image)
+
+    for image in unmatched:
+        print('Unmatched image "{}" [{}] {}'.format(
+            image.name, image.id, image.locations[0]["url"]))
+
     if all:
-        for image in glance.images.list():
-            _fix_provider_location(logger, glance, image)
+        print("{fixed} fixed, {unchanged} unchanged, {unmatched} unmatched, "
+            "{failed} failed".format(**counts))
+
+    if counts[UNMATCHED] or counts[FAILED]:
+        sys.exit(1)
+
+
+@image.command("index")
+@click.option("--format", "-f", default="table",
+    help="Output format: table or csv.")
+def index(format):
+    """
+    Find duplicate and unowned images.
+
+    Images with the same checksum and size are reported as duplicates, along
+    with the space that could be reclaimed by keeping only one copy. Images
+    whose owner is missing or isn't a project are reported as unowned.
+    """
+    client = p9admin.OpenStackClient()
+    client.require_service("image")
+    index = p9admin.image.index_images(client.glance().images.list())
+    # A fresh listing, so images of new projects don't look unowned.
+    project_ids = set([project.id for project in client.projects()])
+
+    duplicates = index.duplicates()
+    unowned = index.unowned(project_ids)
+
+    if format == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["problem", "image_id", "image_name", "owner", "size",
+            "checksum"])
+        for reclaimable, images in duplicates:
+            for info in images:
+                writer.writerow(["duplicate", info.id, info.name, info.owner,
+                    info.size, info.checksum])
+        for info in unowned:
+            writer.writerow(["unowned", info.id, info.name, info.owner,
+                info.size, info.checksum])
+    elif format == "table":
+        for reclaimable, images in duplicates:
+            print("Duplicate {} ({} copies, {} bytes reclaimable)".format(
+                images[0].checksum, len(images), reclaimable))
+            for info in images:
+                print('  Image "{}" [{}] owner {}'.format(
+                    info.name, info.id, info.owner))
+        for info in unowned:
+            print('Unowned image "{}" [{}] owner {}, {} bytes'.format(
+                info.name, info.id, info.owner, info.size))
+
+        print("{} images, {} duplicate groups, {} bytes reclaimable, {} unowned"
+            .format(len(index.images), len(duplicates),
+                sum([reclaimable for reclaimable, images in duplicates]),
+                len(unowned)))
+    else:
+        sys.exit("Format must be csv or table")
+
+
+@image.command("usage")
+@click.option("--format", "-f", default="table",
+    help="Output format: table or csv.")
+@click.option("--top", default=10, show_default=True,
+    help="Number of most used images to show.")
+def usage(format, top):
+    """
+    Find which images are used by servers and volumes.
+
+    Unused images are listed largest first with the space they take. The most
+    used images are listed with their number of servers and volumes.
+    """
+    client = p9admin.OpenStackClient()
+    client.require_service("image")
+    index = p9admin.image.index_images(client.glance().images.list())
+    usage = p9admin.image.image_usage(client, index)
+
+    unused = usage.unused()
+    most_used = usage.most_used(top)
+
+    if format == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["image_id", "image_name", "owner", "size", "servers",
+            "volumes"])
+        for id, info in index.images.items():
+            consumers = usage.consumers.get(id, [])
+            writer.writerow([info.id, info.name, info.owner, info.size,
+                len([c for c in consumers if c.type == "server"]),
+                len([c for c in consumers if c.type == "volume"])])
+    elif format == "table":
+        for info in unused:
+            print('Unused image "{}" [{}] owner {}, {} bytes'.format(
+                info.name, info.id, info.owner, info.size))
+        for id, consumers in most_used:
+            info = index.images.get(id)
+            print('Image "{}" [{}] used by {} servers and {} volumes'.format(
+                info.name if info else "(deleted)", id,
+                len([c for c in consumers if c.type == "server"]),
+                len([c for c in consumers if c.type == "volume"])))
+
+        print("{} images, {} in use, {} unused ({} bytes), {} deleted but in use"
+            .format(len(index.images), len(usage.consumers) - len(usage.missing()),
+                len(unused), sum([info.size for info in unused]),
+                len(usage.missing())))
     else:
-        image = glance.images.get(id)
-        _fix_provider_location(logger, glance, image)
+        sys.exit("Format must be csv or table")
+
+
+@image.command("copy")
+@click.argument("id")
+@click.option("--to-project", metavar="PROJECT",
+    help="Project to own the copy. Defaults to the source image's owner.")
+@click.option("--to-region", metavar="REGION",
+    help="Region to copy to. Defaults to the current region.")
+@click.option("--name", help="Name for the copy. Defaults to the source name.")
+def copy(id, to_project, to_region, name):
+    """
+    Copy an image to another project or region.
+
+    Image data is streamed straight from the source to the destination, and
+    its checksum is verified. Running the same copy again after it was
+    interrupted reuses the unfinished image.
+    """
+    client = p9admin.OpenStackClient()
+    if to_region:
+        dest_client = client.for_region(to_region)
+    else:
+        dest_client = client
+    client.require_service("image")
+    dest_client.require_service("image")
+
+    owner = None
+    if to_project:
+        owner = client.find_project(to_project, validate=True).id
+
+    try:
+        dest = p9admin.image.copy_image(client.glance(), dest_client.glance(),
+            id, owner=owner, name=name)
+    except (IOError, ValueError) as e:
+        sys.exit(str(e))
+
+    print('Image "{}" [{}]'.format(dest.name, dest.id))
@@ -0,0 +1,64 @@
+from __future__ import print_function
+import click
+import logging
+import p9admin
+import p9admin.network
+import time
+
+@click.group()
+def network():
+    """Inspect networking across all projects."""
+    pass
+
+
+@network.command()
+@click.option("--external-projects", is_flag=True,
+    help="List projects with a router gatewayed to an external network.")
+@click.option("--no-gateway", is_flag=True,
+    help="List routers without an external gateway.")
+@click.option("--overlapping-subnets", is_flag=True,
+    help="List overlapping subnets on the same network or router.")
+@click.option("--json", "json_path", metavar="FILE",
+    help="Export the topology graph to FILE as JSON.")
+@click.option("--graphml", "graphml_path", metavar="FILE",
+    help="Export the topology graph to FILE as GraphML.")
+def topology(external_projects, no_gateway, overlapping_subnets, json_path,
+        graphml_path):
+    """
+    Load the network topology for all projects and query it.
+
+    Networks, subnets, routers, and ports are each listed once.
+    """
+    logger = logging.getLogger(__name__)
+    client = p9admin.OpenStackClient()
+    topology = p9admin.network.load_topology(client)
+    project_names = client.project_names()
+
+    start = time.time()
+
+    if external_projects:
+        for network in topology.external_networks():
+            print('External network "{}" [{}]'.format(network.name, network.id))
+            for project_id in topology.projects_routed_through(network.id):
+                print('  Project "{}" [{}]'.format(
+                    project_names.get(project_id, ""), project_id))
+
+    if no_gateway:
+        for router in topology.routers_without_gateway():
+            print('Router "{}" [{}] in project "{}" [{}] has no gateway'.format(
+                router.name, router.id,
+                project_names.get(router.project_id, ""), router.project_id))
+
+    if overlapping_subnets:
+        for group_id, a, b in topology.overlapping_subnets():
+            type, group = topology.nodes[group_id]
+            print('{} "{}" [{}]: subnet "{}" [{}] {} overlaps "{}" [{}] {}'
+                .format(type.capitalize(), group.name, group_id,
+                    a.name, a.id, a.cidr, b.name, b.id, b.cidr))
+
+    logger.info("Queries took %.3f seconds", time.time() - start)
+
+    if json_path:
+        topology.write_json(json_path)
+    if graphml_path:
+        topology.write_graphml(graphml_path)
@@ -1,9 +1,15 @@
 from __future__ import print_function
 import click
+import collections
 import csv
 import json
 import os
 import p9admin
+import p9admin.idle
+import p9admin.quota
+import p9admin.regions
+import p9admin.security_group
+import p9admin.sweep
 import p9admin.validators as validators
 import pprint
 import sys
@@ -73,11 +79,9 @@ def apply_quota_all(quota_name, quota_value, force=False, defaults=False):
     """
 
     client = p9admin.OpenStackClient()
+    client.require_service("quota")
     projects = client.projects()
 
-    if "OS_NOVA_URL" not in os.environ:
-        sys.exit("OS_NOVA_URL environment variable must be set.  Check README.md")
-
     client.logger.info("Starting application of quotas to all projects")
 
     if defaults:
@@ -126,9 +130,7 @@ def apply_quota(project_name, quota_name, quota_value, defaults):
     """
 
     client = p9admin.OpenStackClient()
-
-    if "OS_NOVA_URL" not in os.environ:
-        sys.exit("OS_NOVA_URL environment variable must be set.  Check README.md")
+    client.require_service("quota")
 
     project = client.project_by_name(project_name)
 
@@ -144,14 +146,53 @@ def apply_quota(project_name, quota_name, quota_value, defaults):
     pprint.pprint(p9admin.project.apply_quota(client, project.id, quota_name, quota_value))
 
 
+@project.command("quota-autotune")
+@click.argument("names", nargs=-1)
+@click.option("--policy", default="conf/autotune.ini", show_default=True,
+    help="INI file with headroom, floor, and ceiling for each quota.")
+@click.option("--headroom", type=float,
+    help="Headroom over usage for all quotas, e.g. 0.5 for 50%. Overrides the policy file.")
+@click.option("--apply/--no-apply", default=False,
+    help="Apply the recommended quotas instead of just showing them.")
+@click.option("--workers", "-w", default=8, show_default=True)
+def quota_autotune(names, policy, headroom, apply, workers):
+    """
+    Fit quotas to usage.
+
+    Recommends a quota for each resource in the policy file based on how much
+    of it the project uses, plus headroom, within the floor and ceiling.
+    Unlimited quotas are left alone. Checks all projects if no NAMES are given.
+    """
+    policies = p9admin.quota.load_policies(policy, headroom)
+    client = p9admin.OpenStackClient(workers=workers)
+    client.require_service("quota")
+    if names:
+        projects = [client.project_by_name(name) for name in names]
+    else:
+        projects = client.projects()
+
+    plans, failures = p9admin.quota.plan_autotune(client, projects, policies,
+        workers=workers)
+
+    for project, changes in plans:
+        print('Project "{}" [{}]'.format(project.name, project.id))
+        for change in changes:
+            print("  {:<25} in use {:>8}  {:>8} -> {:<8}".format(change.resource,
+                change.in_use, change.limit, change.recommended))
+
+    if apply and plans:
+        failures += p9admin.quota.apply_autotune(client, plans, workers=workers)
+
+    if failures:
+        sys.exit("Failed on {} projects".format(len(failures)))
+
+
 @project.command("get-quota")
 @click.option("--project_name", "-p")
 def get_quota(project_name):
     """Get a list of quotas for a project."""
-    if "OS_NOVA_URL" not in os.environ:
-        sys.exit("OS_NOVA_URL environment variable must be set.  Check README.md")
-
     client = p9admin.OpenStackClient()
+    client.require_service("quota")
     project = client.project_by_name(project_name)
 
     pprint.pprint(p9admin.project.get_quota(client, project.id))
@@ -172,6 +213,7 @@ def list():
 def delete(names):
     """Delete project(s) and the objects within."""
     client = p9admin.OpenStackClient()
+    client.plan_inventory(len(names))
     for name in names:
         p9admin.project.delete_project(client, name)
 
@@ -185,8 +227,17 @@ def delete(names):
               prompt="puppetpass_password" not in os.environ,
               hide_input=True,
               default=os.environ.get('puppetpass_password', None))
-def ensure_ldap(name, group_cn, uid, password):
-    """Ensure a project exists based on an LDAP group."""
+@click.option("--group-mode/--user-mode", default=False,
+              help="Grant access through a Keystone group that mirrors the "
+                   "LDAP group, rather than to each user.")
+def ensure_ldap(name, group_cn, uid, password, group_mode):
+    """
+    Ensure a project exists based on an LDAP group.
+
+    With --group-mode, the LDAP group is mirrored into a Keystone group with
+    the same name, which is given access to the project. Users' direct access
+    to the project is then revoked.
+    """
 
     if not uid:
         sys.exit("You must specify --uid USER to connect to LDAP")
@@ -207,13 +258,268 @@ def ensure_ldap(name, group_cn, uid, password):
 
     client.ensure_users(users)
     user_ids = [user.user.id for user in users]
-    client.ensure_project_members(project, user_ids, keep_others=False)
+    if group_mode:
+        client.ensure_project_groups(project, {group_cn: user_ids})
+    else:
+        client.ensure_project_members(project, user_ids, keep_others=False)
 
     print('Project "{}" [{}]'.format(project.name, project.id))
 
 
+@project.command("ensure-ldap-all")
+@click.argument("file", type=click.Path(exists=True, dir_okay=False))
+@click.option("--uid", "-u", envvar='puppetpass_username')
+@click.option("--password", "-p",
+              prompt="puppetpass_password" not in os.environ,
+              hide_input=True,
+              default=os.environ.get('puppetpass_password', None))
+@click.option("--group-mode/--user-mode", default=False,
+              help="Grant access through a Keystone group that mirrors the "
+                   "LDAP group, rather than to each user.")
+def ensure_ldap_all(file, uid, password, group_mode):
+    """
+    Ensure projects exist based on many LDAP groups.
+
+    Each row of FILE is: LDAP group CN, project name. The project name defaults
+    to the group CN. All groups are loaded with one LDAP search, each user is
+    set up once, and project membership is compared against one listing of
+    role assignments.
+
+    Several groups may map to one project; its members are everyone in any of
+    them. If any of a project's groups is empty, the project is left alone.
+
+    --group-mode works as it does for ensure-ldap.
+    """
+
+    if not uid:
+        sys.exit("You must specify --uid USER to connect to LDAP")
+
+    mapping = []
+    with open(file) as f:
+        for row in csv.reader(f):
+            row = [field.strip() for field in row]
+            if not row or not row[0] or row[0].startswith("#"):
+                continue
+            if len(row) < 2 or not row[1]:
+                mapping.append((row[0], row[0]))
+            else:
+                mapping.append((row[0], row[1]))
+
+    client = p9admin.OpenStackClient()
+
+    groups = p9admin.user.get_ldap_groups_users(
+        [group_cn for group_cn, name in mapping], uid, password)
+
+    client.logger.info("Ensuring all users exist and have their own projects")
+    client.ensure_users([user for users in groups.values() for user in users])
+
+    existing_user_ids = client.project_user_ids("_member_")
+
+    # Project name -> {group CN: user IDs}, so that each project is diffed
+    # once against the members of all of its groups.
+    project_groups = collections.OrderedDict()
+    failed = set()
+    for group_cn, name in mapping:
+        users = groups[group_cn]
+        if not users:
+            client.logger.error("LDAP group %s doesn't contain any users", group_cn)
+            failed.add(name)
+            continue
+        project_groups.setdefault(name, {})[group_cn] = \
+            [user.user.id for user in users]
+
+    for name, group_user_ids in project_groups.items():
+        if name in failed:
+            client.logger.error('Not changing project "%s": one of its groups '
+                'is empty', name)
+            continue
+
+        project = p9admin.project.ensure_project(client, name)
+        if group_mode:
+            client.ensure_project_groups(project, group_user_ids,
+                existing_user_ids=existing_user_ids[project.id])
+        else:
+            user_ids = set()
+            for ids in group_user_ids.values():
+                user_ids.update(ids)
+            client.ensure_project_members(project, user_ids, keep_others=False,
+                existing_user_ids=existing_user_ids[project.id])
+
+        print('Project "{}" [{}]'.format(project.name, project.id))
+
+    if failed:
+        sys.exit(1)
+
+
+@project.command()
+@click.option("--days", "-d", default=30, show_default=True,
+    help="Minimum number of days servers and volumes must have been idle.")
+@click.option("--format", "-f", default="table")
+def idle(days, format):
+    """
+    List idle servers, volumes, and floating IPs.
+
+    Servers shut off and volumes not attached for at least --days days, and
+    floating IPs not associated with a port, are listed largest first with the
+    project that owns them. Idle time is based on when each was last updated.
+    """
+    if format not in ("csv", "table"):
+        sys.exit("Format must be csv or table")
+
+    client = p9admin.OpenStackClient()
+    idle = p9admin.idle.find_idle(client, days)
+    project_names = client.project_names()
+
+    if format == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["type", "id", "name", "project_id", "project_name",
+            "size", "unit", "idle_days"])
+        for type in ("server", "volume", "floating_ip"):
+            for item in idle[type]:
+                writer.writerow([type, item.id, item.name, item.project_id,
+                    project_names.get(item.project_id, ""), item.size, item.unit,
+                    item.idle_days])
+    else:
+        for type in ("server", "volume", "floating_ip"):
+            items = idle[type]
+            if not items:
+                continue
+            print("{} idle {}s, {} {}".format(len(items), type,
+                sum([item.size for item in items]), items[0].unit))
+            for item in items:
+                print('  "{}" [{}] project "{}" [{}] {} {}, idle {} days'.format(
+                    item.name, item.id, project_names.get(item.project_id, ""),
+                    item.project_id, item.size, item.unit,
+                    "?" if item.idle_days is None else item.idle_days))
+
+
+def _format_rule(rule):
+    if rule.remote_group_id:
+        remote = "<{}>".format(rule.remote_group_id)
+    else:
+        remote = str(rule.cidr)
+
+    if rule.ports == (None, None):
+        ports = "all"
+    elif rule.ports[0] == rule.ports[1]:
+        ports = str(rule.ports[0])
+    else:
+        ports = "{}-{}".format(*rule.ports)
+
+    return "{} {} {} {} {} {}".format(rule.direction, rule.ethertype,
+        rule.protocol or "all", remote, "ports" if rule.protocol in
+        p9admin.security_group.PORT_PROTOCOLS else "type/code", ports)
+
+
+@project.command("sg-compact")
+@click.argument("names", metavar="[NAME ...]", nargs=-1)
+@click.option("--apply/--no-apply", default=False,
+    help="Replace the rules in each group with the compacted set.")
+def sg_compact(names, apply):
+    """
+    Find smaller equivalent sets of security group rules.
+
+    Duplicate rules, rules contained in other rules, adjacent port ranges, and
+    adjacent or nested CIDRs are merged. Only rules with the same direction,
+    ethertype, protocol, and remote group are merged with each other. Looks at
+    all projects unless project NAMEs are given.
+
+    With --apply, new rules are created before the old ones are deleted, so
+    the allowed traffic never changes.
+    """
+    client = p9admin.OpenStackClient()
+
+    project_ids = None
+    if names:
+        project_ids = set([client.find_project(name).id for name in names])
+
+    compactions = p9admin.security_group.plan_compaction(client, project_ids)
+
+    for compaction in compactions:
+        sg = compaction.security_group
+        print('Security group "{}" [{}] in project [{}]: {} rules -> {} (-{})'
+            .format(sg.name, sg.id, sg.project_id, len(compaction.existing),
+                len(compaction.compacted),
+                len(compaction.existing) - len(compaction.compacted)))
+        for rule in compaction.compacted:
+            print("    " + _format_rule(rule))
+
+    print("{} security groups, {} rules -> {}".format(len(compactions),
+        sum([len(c.existing) for c in compactions]),
+        sum([len(c.compacted) for c in compactions])))
+
+    if apply:
+        failed = 0
+        for compaction in compactions:
+            try:
+                p9admin.security_group.apply_compaction(client, compaction)
+            except Exception as e:
+                client.logger.error('Failed to compact security group [%s]: %s',
+                    compaction.security_group.id, e)
+                failed += 1
+        if failed:
+            sys.exit("Failed to compact {} security groups".format(failed))
+
+
+@project.command()
+@click.option("--format", "-f", default="table")
+@click.option("--delete/--no-delete", default=False,
+    help="Delete the orphaned resources.")
+@click.option("--workers", "-w", default=8, show_default=True,
+    help="Number of concurrent deletions.")
+@click.option("--yes", "-y", default=False, is_flag=True,
+    help="Delete without asking for confirmation.")
+def sweep(format, delete, workers, yes):
+    """
+    Find resources left behind by deleted projects.
+
+    Servers, volumes, floating IPs, routers, ports, networks, and security
+    groups that belong to a project that no longer exists are listed by type,
+    largest first. With --delete they are deleted, one type at a time in an
+    order that respects their dependencies.
+    """
+    if format not in ("csv", "table"):
+        sys.exit("Format must be csv or table")
+
+    client = p9admin.OpenStackClient(workers=workers)
+    orphans = p9admin.sweep.find_orphans(client)
+
+    if format == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["type", "id", "name", "project_id", "size", "unit"])
+        for type in p9admin.sweep.TYPES:
+            for orphan in orphans[type]:
+                writer.writerow([type, orphan.id, orphan.name,
+                    orphan.project_id, orphan.size, p9admin.sweep.UNITS[type]])
+    else:
+        for type in p9admin.sweep.TYPES:
+            if not orphans[type]:
+                continue
+            print("{} {} orphans, {} {}".format(len(orphans[type]), type,
+                sum([orphan.size for orphan in orphans[type]]),
+                p9admin.sweep.UNITS[type]))
+            for orphan in orphans[type]:
+                print('  "{}" [{}] project [{}] {} {}'.format(orphan.name,
+                    orphan.id, orphan.project_id, orphan.size,
+                    p9admin.sweep.UNITS[type]))
+
+    if delete:
+        count = sum([len(orphans[type]) for type in p9admin.sweep.TYPES])
+        if not count:
+            return
+        if not yes:
+            click.confirm("Delete {} orphaned resources?".format(count),
+                abort=True, err=True)
+        failures = p9admin.sweep.delete_orphans(client, orphans, workers=workers)
+        if failures:
+            sys.exit("Failed to delete {} resources".format(len(failures)))
+
+
 @project.command()
-def stats():
+@click.option("--regions", "-r", multiple=True, metavar="REGION[,REGION]",
+    callback=p9admin.regions.parse_regions,
+    help="Query several regions concurrently and add a region column.")
+def stats(regions):
     """
     Get information about usage of all projects.
 
@@ -222,8 +528,7 @@ def stats():
     client = p9admin.OpenStackClient()
     projects = client.projects()
 
-    writer = csv.writer(sys.stdout)
-    writer.writerow([
+    header = [
         "project_id",
         "project_name",
         "count_servers",
@@ -232,8 +537,25 @@ def stats():
         "size_volumes",
         "count_volumes_inuse",
         "size_volumes_inuse",
-    ])
+    ]
 
-    for project in projects:
-        stats = p9admin.project.get_stats(client, project)
-        writer.writerow([project.id, project.name] + stats)
+    writer = csv.writer(sys.stdout)
+
+    if regions:
+        writer.writerow(["region"] + header)
+
+        def region_stats(client):
+            client.plan_inventory(len(projects))
+            for project in projects:
+                stats = p9admin.project.get_stats(client, project)
+                yield [project.id, project.name] + stats
+
+        for region, row in p9admin.regions.fan_out(client, regions, region_stats):
+            writer.writerow([region] + row)
+    else:
+        writer.writerow(header)
+
+        client.plan_inventory(len(projects))
+        for project in projects:
+            stats = p9admin.project.get_stats(client, project)
+            writer.writerow([project.id, project.name] + stats)
@@ -1,7 +1,10 @@
 from __future__ import print_function
 import click
+import csv
+import json
 import os
 import p9admin
+import p9admin.access
 import p9admin.user
 import sys
 
@@ -92,3 +95,77 @@ def revoke_user(email, project, admin):
 
     client.revoke_project_access(
         client.find_project(project), user=user, role_name=role_name(admin))
+
+
+@user.command("apply-grants")
+@click.argument("file", type=click.Path(exists=True, dir_okay=False))
+@click.option("--workers", "-w", default=8, show_default=True,
+              help="Number of concurrent Keystone requests.")
+def apply_grants(file, workers):
+    """
+    Grant and revoke access in bulk from a CSV file.
+
+    Each row of FILE is: email, project, role, action. Role defaults to
+    _member_ and action (grant or revoke) defaults to grant. Assignments that
+    are already in the requested state are left alone.
+    """
+    client = p9admin.OpenStackClient(workers=workers)
+    grants = p9admin.user.load_grants(file)
+    changes, unchanged, failures, seconds = p9admin.user.apply_grants(
+        client, grants, workers=workers)
+
+    for grant in sorted(changes):
+        print("{action:6} {email} {project} {role}".format(**grant._asdict()))
+
+    print("{} changed, {} unchanged, {} failed in {:.1f} seconds".format(
+        len(changes), unchanged, len(failures), seconds))
+
+    if failures:
+        sys.exit(1)
+
+
+@user.command("access-report")
+@click.option("--format", "-f", default="csv", help="csv or json")
+@click.option("--by", default="user", type=click.Choice(["user", "project"]),
+              help="Group the report by user or by project.")
+def access_report(format, by):
+    """
+    Report which users can access which projects.
+
+    Role assignments for all projects are loaded at once, and access granted
+    through groups is expanded to the group's members.
+    """
+    if format not in ("csv", "json"):
+        sys.exit("Format must be csv or json")
+
+    client = p9admin.OpenStackClient()
+    matrix = p9admin.access.access_matrix(client)
+
+    if format == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["user_id", "user_name", "project_id", "project_name",
+            "roles", "via"])
+        for user_id, project_id, accesses in matrix.rows(by):
+            writer.writerow([
+                user_id,
+                matrix.user_names[user_id],
+                project_id,
+                matrix.project_names[project_id],
+                " ".join(sorted(set([access.role for access in accesses]))),
+                " ".join(sorted(set([access.via or "direct" for access in accesses]))),
+            ])
+    else:
+        report = {}
+        for user_id, project_id, accesses in matrix.rows(by):
+            if by == "user":
+                outer = report.setdefault(matrix.user_names[user_id],
+                    {"id": user_id, "projects": {}})["projects"]
+                inner = matrix.project_names[project_id]
+            else:
+                outer = report.setdefault(matrix.project_names[project_id],
+                    {"id": project_id, "users": {}})["users"]
+                inner = matrix.user_names[user_id]
+            outer[inner] = [{"role": access.role, "via": access.via}
+                for access in accesses]
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
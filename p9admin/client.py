@@ -1,4 +1,5 @@
 from __future__ import print_function
+import collections
 import functools
 import glanceclient.v2
 import keystoneclient.v3
@@ -6,9 +7,24 @@ import keystoneauth1
 import keystoneauth1.identity
 import logging
 import openstack
+import openstack.exceptions
+import openstack.network.v2.floating_ip
+import openstack.network.v2.network
+import openstack.network.v2.port
+import openstack.network.v2.router
+import openstack.network.v2.security_group
+import openstack.network.v2.security_group_rule
+import openstack.network.v2.subnet
 import os
 import p9admin
+import p9admin.index
+import p9admin.ledger
+import p9admin.trace
+import p9admin.wire
+import requests
+import requests.adapters
 import sys
+import threading
 
 class TooManyError(Exception):
     """Too many results found"""
@@ -16,21 +32,104 @@ class TooManyError(Exception):
 
 def memoize(obj):
     # This does not work with generators.
+    #
+    # Safe to call from multiple threads: each distinct set of arguments is
+    # computed exactly once, and calls with different arguments don't block
+    # each other.
     cache = obj.cache = {}
+    locks = {}
+    locks_lock = threading.Lock()
 
     @functools.wraps(obj)
     def memoizer(*args):
-        if args not in cache:
-            cache[args] = obj(*args)
+        try:
+            return cache[args]
+        except KeyError:
+            pass
+
+        with locks_lock:
+            lock = locks.setdefault(args, threading.RLock())
+        with lock:
+            if args not in cache:
+                cache[args] = obj(*args)
         return cache[args]
     return memoizer
 
 def add_memo(obj, args, memo):
     obj.cache[args] = memo
 
+# Service catalog types for each capability, in order of preference.
+SERVICE_TYPES = {
+    "compute": ("compute",),
+    "image": ("image",),
+    "network": ("network",),
+    "volume": ("block-storage", "volumev3", "volumev2", "volume"),
+}
+
+# Neutron resources that can be listed with only some fields.
+NEUTRON_RESOURCES = {
+    "floatingips": openstack.network.v2.floating_ip.FloatingIP,
+    "networks": openstack.network.v2.network.Network,
+    "ports": openstack.network.v2.port.Port,
+    "routers": openstack.network.v2.router.Router,
+    "security_groups": openstack.network.v2.security_group.SecurityGroup,
+    "security_group_rules": openstack.network.v2.security_group_rule.SecurityGroupRule,
+    "subnets": openstack.network.v2.subnet.Subnet,
+}
+
+def http_session(workers=None):
+    """
+    requests session for keystoneauth sessions to use
+
+    The connection pool for each host is sized for workers concurrent
+    requests so that worker threads don't wait for (or discard) connections.
+    Response sizes are counted by p9admin.wire. requests already asks for
+    gzip compressed responses.
+    """
+    session = requests.Session()
+    session.hooks["response"].append(p9admin.trace.response_hook)
+    session.hooks["response"].append(p9admin.wire.response_hook)
+
+    if workers:
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=workers, pool_maxsize=workers)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+    return session
+
+INVENTORY_STRATEGIES = ("auto", "scan", "filter")
+
 class OpenStackClient(object):
-    def __init__(self, project_name=os.environ["OS_PROJECT_NAME"]):
+    """
+    Admin client for Keystone, Glance, and the OpenStack SDK services
+
+    One client may be shared by a pool of worker threads. The session (and
+    its token) is shared; keystoneauth serializes re-authentication. Service
+    clients and cached listings are created at most once per client, even if
+    several threads ask for them at the same time. Pass workers to size the
+    HTTP connection pool for the number of threads that will share it.
+    """
+
+    # How servers(project_id) and volumes(project_id) get their data:
+    #   scan:   list everything in the cloud once and filter locally
+    #   filter: ask the server for just the one project each time
+    #   auto:   filter until more than filter_limit projects have been asked
+    #           for (or plan_inventory() says to expect that many), then scan
+    inventory_strategy = "auto"
+    filter_limit = 5
+
+    def __init__(self, project_name=os.environ["OS_PROJECT_NAME"],
+            region_name=os.environ.get("OS_REGION_NAME"), session=None,
+            workers=None):
         self.logger = logging.getLogger(__name__)
+        self.region_name = region_name
+        # Project IDs filtered server-side so far, by kind of resource
+        self.filtered_projects = {"servers": set(), "volumes": set()}
+
+        if session is not None:
+            self.session = session
+            return
 
         self.logger.info('Authenticating as "%s" on project "%s" with password',
             os.environ["OS_USERNAME"], project_name)
@@ -43,21 +142,92 @@ class OpenStackClient(object):
             project_domain_id=os.environ.get("OS_PROJECT_DOMAIN_ID", "default"),
         )
 
-        self.session = keystoneauth1.session.Session(auth=auth)
+        self.session = keystoneauth1.session.Session(auth=auth,
+            session=http_session(workers))
+
+    def for_region(self, region_name):
+        """
+        Get a client for another region
+
+        The new client shares this client's session, so it doesn't need to
+        authenticate again. Caches are not shared.
+        """
+        return self.__class__(region_name=region_name, session=self.session)
 
     @memoize
     def glance(self):
-        return glanceclient.v2.client.Client(session=self.session)
+        return glanceclient.v2.client.Client(session=self.session,
+            region_name=self.region_name)
 
     @memoize
     def keystone(self):
-        return keystoneclient.v3.client.Client(session=self.session)
+        return keystoneclient.v3.client.Client(session=self.session,
+            region_name=self.region_name)
 
     @memoize
     def openstack(self):
-        return openstack.connect(session=self.session)
+        return openstack.connect(session=self.session,
+            region_name=self.region_name)
+
+    @memoize
+    def ledger(self):
+        """
+        Record of verified projects
+
+        Projects verified within P9ADMIN_VERIFY_TTL seconds (default four
+        days) are not verified again by ensure_project.
+        """
+        return p9admin.ledger.Ledger(os.environ["OS_AUTH_URL"],
+            ttl=int(os.environ.get("P9ADMIN_VERIFY_TTL",
+                p9admin.ledger.DEFAULT_TTL)))
+
+    @memoize
+    def index(self):
+        """Name to ID index for projects, users and roles"""
+        return p9admin.index.NameIndex(self, os.environ["OS_AUTH_URL"])
+
+    @memoize
+    @p9admin.trace.traced
+    def capabilities(self):
+        """
+        Find which services are available
+
+        This checks the service catalog once, so that commands can skip
+        missing services without making requests that are bound to fail.
+        Returns a set of names from SERVICE_TYPES, plus "quota" if there is a
+        compute service and OS_NOVA_URL is set.
+        """
+        catalog = self.session.auth.get_access(self.session).service_catalog
+
+        available = set()
+        for name, service_types in SERVICE_TYPES.items():
+            for service_type in service_types:
+                if catalog.get_urls(service_type=service_type,
+                        interface="public", region_name=self.region_name):
+                    available.add(name)
+                    break
+            else:
+                self.logger.warning('No %s service in region "%s"',
+                    name, self.region_name)
+
+        if "compute" in available and os.environ.get("OS_NOVA_URL"):
+            available.add("quota")
+
+        return available
+
+    def has_service(self, name):
+        return name in self.capabilities()
+
+    def require_service(self, name):
+        """Exit if a service from capabilities() isn't available"""
+        if self.has_service(name):
+            return
+        if name == "quota" and "OS_NOVA_URL" not in os.environ:
+            sys.exit("OS_NOVA_URL environment variable must be set.  Check README.md")
+        sys.exit('No {} service in region "{}"'.format(name, self.region_name))
 
     @memoize
+    @p9admin.trace.traced
     def api_token(self):
         """
         Get an API Token to make api requests.  This may be necessary for
@@ -70,15 +240,15 @@ class OpenStackClient(object):
 
         return conn.authorize()
 
+    @p9admin.trace.traced
     def project_by_name(self, project_name):
-        # Find Project
-        try:
-            project = self.keystone().projects.find(name=project_name)
-            self.logger.info('Found "%s" project [%s]', project.name, project.id)
-        except keystoneauth1.exceptions.NotFound:
+        project = self.index().lookup("projects", project_name, by_id=False)
+        if project is None:
             sys.exit('Project "{}" not found, check your spelling, or create with ensure_project'.format(project_name))
+        self.logger.info('Found "%s" project [%s]', project.name, project.id)
         return project
 
+    @p9admin.trace.traced
     def projects(self):
         try:
             projects = self.keystone().projects.list()
@@ -86,23 +256,32 @@ class OpenStackClient(object):
             sys.exit("Can't List Projects")
         return projects
 
+    @memoize
+    def project_names(self):
+        """Map the ID of every project to its name, from a fresh listing"""
+        return dict((project.id, project.name) for project in self.projects())
 
     @memoize
+    @p9admin.trace.traced
     def role(self, name):
-        return self.keystone().roles.find(name=name)
+        role = self.index().role(name)
+        if role is None:
+            sys.exit('Role "{}" not found'.format(name))
+        return role
 
     @memoize
+    @p9admin.trace.traced
     def service_project(self):
-        try:
-            project = self.keystone().projects.find(name="service")
-            self.logger.info('Found "%s" project [%s]', project.name, project.id)
-        except keystoneauth1.exceptions.NotFound:
+        project = self.index().lookup("projects", "service", by_id=False)
+        if project is None:
             self.logger.critical('Could not find project "service"')
             sys.exit(1)
+        self.logger.info('Found "%s" project [%s]', project.name, project.id)
 
         return project
 
     @memoize
+    @p9admin.trace.traced
     def external_network(self):
         name = "external"
         network = self.openstack().network.find_network(
@@ -115,17 +294,24 @@ class OpenStackClient(object):
         return network
 
     @memoize
+    @p9admin.trace.traced
     def groups(self):
         groups = self.keystone().groups.list()
         self.logger.info('Retrieved %d groups', len(groups))
         return groups
 
+    @memoize
+    @p9admin.trace.traced
+    def group_members(self, group_id):
+        return self.keystone().users.list(group=group_id)
+
     def subnets(self, *args, **kwargs):
         for subnet in self.openstack().network.subnets(*args, **kwargs):
             add_memo(self.subnet, (self, subnet.id), subnet)
             yield subnet
 
     @memoize
+    @p9admin.trace.traced
     def subnet(self, id):
         return self.openstack().network.get_subnet(id)
 
@@ -135,32 +321,136 @@ class OpenStackClient(object):
             yield sg
 
     @memoize
+    @p9admin.trace.traced
     def security_group(self, id):
         return self.openstack().network.get_security_group(id)
 
+    @p9admin.trace.traced
+    def network_list(self, resource, fields):
+        """
+        List every Neutron resource of a type with only some of its fields
+
+        resource is a key of NEUTRON_RESOURCES and fields are the names Neutron
+        uses in its API, e.g. "ethertype" rather than the SDK's "ether_type".
+        Asking for fewer fields makes the response much smaller for ports and
+        security group rules. Returns SDK resource objects with only those
+        attributes set.
+
+        If p9admin.wire.compare_projection is set, the full listing is fetched
+        too, only to measure how much smaller the projected one is.
+        """
+        resource_class = NEUTRON_RESOURCES[resource]
+
+        items = []
+        projected = 0
+        for body, size in self._network_pages(resource, {"fields": list(fields)}):
+            items.extend([resource_class.existing(**item) for item in body[resource]])
+            projected += size
+
+        full = None
+        if p9admin.wire.compare_projection:
+            full = sum([size for body, size in self._network_pages(resource, {})])
+        p9admin.wire.record_listing("Neutron " + resource, projected, full)
+
+        return items
+
+    def _network_pages(self, resource, params):
+        """Yield (body, decoded size) for each page of a Neutron listing"""
+        network = self.openstack().network
+        response = network.get("/" + resource, params=params)
+        while True:
+            openstack.exceptions.raise_from_response(response)
+            body = response.json()
+            yield body, len(response.content)
+            next_links = [link["href"] for link in body.get(resource + "_links", [])
+                if link.get("rel") == "next"]
+            if not next_links:
+                return
+            response = network.get(next_links[0])
+
     @memoize
+    @p9admin.trace.traced
     def all_volumes(self):
+        if not self.has_service("volume"):
+            return []
         return list(self.openstack().block_storage.volumes(details=True, all_tenants=True))
 
     def volumes(self, project_id):
-        for volume in self.all_volumes():
-            if volume.project_id == project_id:
+        if self._scan_inventory("volumes", project_id):
+            for volume in self.all_volumes():
+                if volume.project_id == project_id:
+                    yield volume
+        elif self.has_service("volume"):
+            for volume in self.openstack().block_storage.volumes(
+                    details=True, all_tenants=True, project_id=project_id):
                 yield volume
 
     @memoize
+    @p9admin.trace.traced
     def all_servers(self):
+        if not self.has_service("compute"):
+            return []
         return list(self.openstack().compute.servers(details=True, all_tenants=True))
 
+    @memoize
+    @p9admin.trace.traced
+    def flavors(self):
+        """Get a dict of all flavors, public and private, by ID"""
+        flavors = self.openstack().compute.flavors(details=True, is_public=None)
+        return dict((flavor.id, flavor) for flavor in flavors)
+
     def servers(self, project_id):
-        for server in self.all_servers():
-            if server.project_id == project_id:
+        if self._scan_inventory("servers", project_id):
+            for server in self.all_servers():
+                if server.project_id == project_id:
+                    yield server
+        elif self.has_service("compute"):
+            for server in self.openstack().compute.servers(
+                    details=True, all_tenants=True, project_id=project_id):
                 yield server
 
+    def plan_inventory(self, project_count):
+        """
+        Tell the auto inventory strategy how many projects to expect
+
+        Commands that know they will look at many projects should call this
+        so that they scan once up front instead of filtering a few first.
+        """
+        if self.inventory_strategy == "auto" and project_count > self.filter_limit:
+            self.logger.info("Expecting %d projects: scanning full inventory",
+                project_count)
+            self.inventory_strategy = "scan"
+
+    def _scan_inventory(self, kind, project_id):
+        """Decide whether to use the full listing of kind for project_id"""
+        full_listing = getattr(self, "all_" + kind)
+        if (self,) in full_listing.cache:
+            # Already loaded
+            return True
+
+        if self.inventory_strategy == "scan":
+            strategy = "scan"
+        elif self.inventory_strategy == "filter":
+            strategy = "filter"
+        else:
+            filtered = self.filtered_projects[kind]
+            filtered.add(project_id)
+            if len(filtered) > self.filter_limit:
+                strategy = "scan"
+            else:
+                strategy = "filter"
+
+        if strategy == "scan":
+            self.logger.info("Listing all %s in the cloud (%s strategy)",
+                kind, self.inventory_strategy)
+            return True
+
+        self.logger.info("Listing %s for project [%s] with a server-side filter "
+            "(%s strategy)", kind, project_id, self.inventory_strategy)
+        return False
+
     def _find_user(self, email):
-        try:
-            return self.keystone().users.find(name=email)
-        except keystoneauth1.exceptions.http.NotFound:
-            return None
+        return self.index().user(email)
 
     def find_user(self, email):
         if isinstance(email, p9admin.User):
@@ -170,6 +460,7 @@ class OpenStackClient(object):
         else:
             return self._find_user(email)
 
+    @p9admin.trace.traced
     def ensure_user(self, user, default_project=None):
         if user.user:
             return user.user
@@ -184,21 +475,58 @@ class OpenStackClient(object):
                 email=user.email,
                 description=user.name,
                 default_project=default_project)
+            self.index().add("users", user.user)
             self.logger.info('Created local user "%s" [%s]',
                 user.user.name, user.user.id)
         return user.user
 
+    @p9admin.trace.traced
     def ensure_users(self, users):
+        """Ensure that each user, and a personal project for them, exists"""
+        seen = set()
         for user in users:
+            if user.email in seen:
+                continue
+            seen.add(user.email)
             project = p9admin.project.ensure_project(self, user.name)
             user.user = self.ensure_user(user, default_project=project)
             self.grant_project_access(project, user=user.user)
 
-    def ensure_project_members(self, project, ensure_user_ids, role_name="_member_", keep_others=False):
+    @p9admin.trace.traced
+    def project_user_ids(self, role_name=None):
+        """
+        Get the IDs of users with role_name, or any role, on each project
+
+        Returns a dict of project ID to set of user IDs from a single listing
+        of role assignments. Group assignments are ignored.
+        """
+        user_ids = collections.defaultdict(set)
+        if role_name is None:
+            role_assignments = self.keystone().role_assignments.list()
+        else:
+            role_assignments = self.keystone().role_assignments.list(
+                role=self.role(role_name))
+        for assignment in role_assignments:
+            if hasattr(assignment, "user") and "project" in assignment.scope:
+                user_ids[assignment.scope["project"]["id"]].add(assignment.user["id"])
+        self.logger.info("Retrieved %d role assignments", len(role_assignments))
+        return user_ids
+
+    @p9admin.trace.traced
+    def ensure_project_members(self, project, ensure_user_ids, role_name="_member_", keep_others=False, existing_user_ids=None):
+        """
+        Grant and revoke access so that exactly ensure_user_ids have access
+
+        Pass existing_user_ids (see project_user_ids()) to avoid listing the
+        project's role assignments.
+        """
         role = self.role(role_name)
 
-        role_assignments = self.keystone().role_assignments.list(project=project)
-        existing_user_ids = set([u.user["id"] for u in role_assignments])
+        if existing_user_ids is None:
+            role_assignments = self.keystone().role_assignments.list(project=project)
+            existing_user_ids = set([u.user["id"] for u in role_assignments
+                if hasattr(u, "user")])
+        existing_user_ids = set(existing_user_ids)
         ensure_user_ids = set(ensure_user_ids)
 
         to_add = ensure_user_ids - existing_user_ids
@@ -230,6 +558,83 @@ class OpenStackClient(object):
             'Updating project "%s" [%s] members: +%d -%d (%d unchanged)',
             project.name, project.id, len(to_add), len(to_delete), len(unchanged))
 
+    @p9admin.trace.traced
+    def ensure_group(self, name, domain_id="default", description=None):
+        """Find the Keystone group called name in a domain, or create it"""
+        for group in self.groups():
+            if group.name == name and group.domain_id == domain_id:
+                self.logger.info('Found group "%s" [%s]', group.name, group.id)
+                return group
+
+        group = self.keystone().groups.create(name=name, domain=domain_id,
+            description=description)
+        self.groups().append(group)
+        self.logger.info('Created group "%s" [%s]', group.name, group.id)
+        return group
+
+    @p9admin.trace.traced
+    def ensure_group_members(self, group, ensure_user_ids):
+        """Add and remove users so that group contains exactly ensure_user_ids"""
+        existing_user_ids = set([user.id for user in self.group_members(group.id)])
+        ensure_user_ids = set(ensure_user_ids)
+
+        to_add = ensure_user_ids - existing_user_ids
+        to_delete = existing_user_ids - ensure_user_ids
+
+        for user_id in to_add:
+            self.keystone().users.add_to_group(user_id, group.id)
+            self.logger.info('Added user [%s] to group "%s"', user_id, group.name)
+
+        for user_id in to_delete:
+            self.keystone().users.remove_from_group(user_id, group.id)
+            self.logger.info('Removed user [%s] from group "%s"', user_id, group.name)
+
+        if to_add or to_delete:
+            self.group_members.cache.pop((self, group.id), None)
+
+        self.logger.info('Updating group "%s" [%s] members: +%d -%d (%d unchanged)',
+            group.name, group.id, len(to_add), len(to_delete),
+            len(ensure_user_ids & existing_user_ids))
+
+    @p9admin.trace.traced
+    def ensure_project_groups(self, project, group_user_ids,
+            role_name="_member_", domain_id="default", existing_user_ids=None):
+        """
+        Give users access to project through groups
+
+        group_user_ids is a dict of group name to the IDs of the users who
+        should be in it. Each group is created if needed and its membership
+        synced, and then it is granted role_name on the project. Direct role
+        assignments on the project are revoked, so each project has one
+        assignment per group however many members it has. The groups are
+        created in domain_id, which defaults to the domain ensure_project
+        creates projects in.
+
+        Only users directly assigned role_name are revoked; access through
+        other roles is left alone. Pass existing_user_ids (see
+        project_user_ids(role_name)) to avoid listing the project's role
+        assignments.
+        """
+        role = self.role(role_name)
+        groups = []
+        for group_name, ensure_user_ids in sorted(group_user_ids.items()):
+            group = self.ensure_group(group_name,
+                domain_id=domain_id,
+                description="Mirror of LDAP group {}".format(group_name))
+            self.ensure_group_members(group, ensure_user_ids)
+            self.grant_project_access(project, group=group, role_name=role_name)
+            groups.append(group)
+
+        if existing_user_ids is None:
+            role_assignments = self.keystone().role_assignments.list(
+                project=project, role=role)
+            existing_user_ids = [a.user["id"] for a in role_assignments
+                if hasattr(a, "user")]
+        self.ensure_project_members(project, [], role_name=role_name,
+            keep_others=False, existing_user_ids=existing_user_ids)
+        return groups
+
+    @p9admin.trace.traced
     def grant_project_access(self, project, user=None, group=None, role_name="_member_"):
         if user is None and group is not None:
             subject = 'group "{}"'.format(group.name)
@@ -249,6 +654,7 @@ class OpenStackClient(object):
                 'Granted %s access to project "%s" with role "%s" [%s]',
                 subject, project.name, role.name, role.id)
 
+    @p9admin.trace.traced
     def revoke_project_access(self, project, user=None, group=None, role_name="_member_"):
         if user is None and group is not None:
             subject = 'group "{}"'.format(group.name)
@@ -268,6 +674,7 @@ class OpenStackClient(object):
                 'No access for %s to project "%s" with role "%s" [%s]',
                 subject, project.name, role.name, role.id)
 
+    @p9admin.trace.traced
     def check_role_assignment(self, role, **kwargs):
         try:
             if self.keystone().roles.check(role, **kwargs):
@@ -276,6 +683,7 @@ class OpenStackClient(object):
             pass
         return False
 
+    @p9admin.trace.traced
     def find_network(self, project, name):
         networks = self.openstack().network.networks(project_id=project.id, name=name)
         for network in networks:
@@ -283,6 +691,7 @@ class OpenStackClient(object):
             return network
         return None
 
+    @p9admin.trace.traced
     def create_network(self, project, name):
         network = self.openstack().network.create_network(
             project_id=project.id, name=name,
@@ -290,6 +699,7 @@ class OpenStackClient(object):
         self.logger.info('Created network "%s" [%s]', network.name, network.id)
         return network
 
+    @p9admin.trace.traced
     def find_subnet(self, project, network, name):
         subnets = self.openstack().network.subnets(
             project_id=project.id, network_id=network.id, name=name)
@@ -299,6 +709,7 @@ class OpenStackClient(object):
             return subnet
         return None
 
+    @p9admin.trace.traced
     def create_subnet(self, project, network, name, cidr):
         subnet = self.openstack().network.create_subnet(
             project_id=project.id, network_id=network.id, name=name,
@@ -307,6 +718,7 @@ class OpenStackClient(object):
             subnet.name, subnet.id, subnet.cidr)
         return subnet
 
+    @p9admin.trace.traced
     def find_router(self, project, name):
         routers = self.openstack().network.routers(project_id=project.id, name=name)
         for router in routers:
@@ -314,6 +726,7 @@ class OpenStackClient(object):
             return router
         return None
 
+    @p9admin.trace.traced
     def create_router(self, project, network, subnet, name):
         router = self.openstack().network.create_router(
             project_id=project.id, name=name,
@@ -335,6 +748,7 @@ class OpenStackClient(object):
 
         return router
 
+    @p9admin.trace.traced
     def find_security_group(self, project, name):
         security_groups = self.openstack().network.security_groups(
             project_id=project.id, name=name)
@@ -343,6 +757,7 @@ class OpenStackClient(object):
             return sg
         return None
 
+    @p9admin.trace.traced
     def create_security_group(self, project, name):
         sg = self.openstack().network.create_security_group(
             name=name, project_id=project.id,
@@ -350,6 +765,7 @@ class OpenStackClient(object):
         self.logger.info('Created security group "%s" [%s]', sg.name, sg.id)
         return sg
 
+    @p9admin.trace.traced
     def find_security_group_rule(self, security_group):
         sg_rules = self.openstack().network.security_group_rules(
             security_group_id=security_group.id,
@@ -362,6 +778,7 @@ class OpenStackClient(object):
                 return sg_rule
         return None
 
+    @p9admin.trace.traced
     def create_security_group_rule(self, security_group):
         sg_rule = self.openstack().network.create_security_group_rule(
             security_group_id=security_group.id,
@@ -372,12 +789,15 @@ class OpenStackClient(object):
             sg_rule.remote_ip_prefix, sg_rule.id)
         return sg_rule
 
-    def find_project(self, name):
-        try:
-            return self.keystone().projects.find(name=name)
-        except keystoneauth1.exceptions.NotFound:
-            # Maybe the name is an ID?
-            try:
-                return self.keystone().projects.get(name)
-            except keystoneauth1.exceptions.http.NotFound:
-                sys.exit('Could not find project with name or ID "%s"' % name)
+    @p9admin.trace.traced
+    def find_project(self, name, validate=False):
+        """
+        Find a project by name or ID
+
+        Pass validate=True before doing anything destructive, so that a stale
+        index entry can't point at the wrong project.
+        """
+        project = self.index().project(name, validate=validate)
+        if project is None:
+            sys.exit('Could not find project with name or ID "%s"' % name)
+        return project
@@ -0,0 +1,159 @@
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Default overcommit limits, matching Nova's default allocation ratios.
+DEFAULT_RATIOS = {"vcpus": 16.0, "ram": 1.5, "disk": 1.0}
+
+RESOURCES = ("vcpus", "ram", "disk")
+
+HostCapacity = collections.namedtuple("HostCapacity",
+    ["name", "servers", "allocated", "physical"])
+
+def hypervisor_host(hypervisor):
+    """The compute service host name, which servers refer to"""
+    service = hypervisor.get("service") or {}
+    return service.get("host") or hypervisor["hypervisor_hostname"]
+
+def hypervisor_size(hypervisor):
+    return [hypervisor["vcpus"], hypervisor["memory_mb"], hypervisor["local_gb"]]
+
+def server_size(client, server):
+    """
+    Get [vcpus, ram, disk] for a server
+
+    Newer compute API versions embed the flavor in the server; older ones only
+    include its ID, so fall back to the flavor table.
+    """
+    flavor = server.flavor
+    if getattr(flavor, "vcpus", None) is None:
+        flavor = client.flavors().get(flavor.id)
+        if flavor is None:
+            logger.warning('Server "%s" [%s] has unknown flavor',
+                server.name, server.id)
+            return [0, 0, 0]
+    return [flavor.vcpus, flavor.ram, flavor.disk]
+
+def get_capacity(client, hypervisors=None):
+    """
+    Get allocated and physical resources for each hypervisor
+
+    Returns a list of HostCapacity sorted by host name. Servers are grouped
+    by host as rows of [vcpus, ram, disk] and summed column-wise.
+    """
+    if hypervisors is None:
+        hypervisors = client.openstack().list_hypervisors()
+
+    servers = servers_by_host(client)
+
+    hosts = []
+    for hypervisor in hypervisors:
+        name = hypervisor_host(hypervisor)
+        host_rows = [size for server, size in servers.pop(name, [])]
+        allocated = list(map(sum, zip([0, 0, 0], *host_rows)))
+        hosts.append(HostCapacity(name, len(host_rows), allocated,
+            hypervisor_size(hypervisor)))
+
+    for name, host_servers in servers.items():
+        logger.warning('%d servers on unknown host "%s"', len(host_servers), name)
+
+    return sorted(hosts, key=lambda host: host.name)
+
+def servers_by_host(client):
+    """Get a dict of host name to list of (server, [vcpus, ram, disk])"""
+    servers = collections.defaultdict(list)
+    for server in client.all_servers():
+        if server.compute_host:
+            servers[server.compute_host].append(
+                (server, server_size(client, server)))
+    return servers
+
+def fleet_capacity(hosts):
+    """Sum a list of HostCapacity into a single HostCapacity"""
+    return HostCapacity("fleet",
+        sum([host.servers for host in hosts]),
+        list(map(sum, zip([0, 0, 0], *[host.allocated for host in hosts]))),
+        list(map(sum, zip([0, 0, 0], *[host.physical for host in hosts]))))
+
+def ratios(host):
+    """Get allocated/physical for each resource (None if physical is 0)"""
+    return [float(a) / p if p else None
+        for a, p in zip(host.allocated, host.physical)]
+
+def overcommitted(host, limits=DEFAULT_RATIOS):
+    """Get the names of resources allocated beyond the limit ratios"""
+    return [resource for resource, ratio in zip(RESOURCES, ratios(host))
+        if ratio is not None and ratio > limits[resource]]
+
+Placement = collections.namedtuple("Placement",
+    ["server", "size", "source", "target"])
+
+def plan_drain(client, drain, limits=DEFAULT_RATIOS):
+    """
+    Plan where to move the servers on the hosts in drain
+
+    Servers are placed first-fit decreasing onto the remaining hosts that are
+    up and enabled, without exceeding the limit ratios on any resource.
+    Servers are ordered by their largest share of the average target host,
+    and each one goes to the first host it fits on. Only the plan is
+    computed; nothing is moved.
+
+    Returns (placements, unplaced) where both are lists of Placement. For
+    unplaced servers the target is None.
+    """
+    drain = set(drain)
+    hypervisors = client.openstack().list_hypervisors()
+    servers = servers_by_host(client)
+
+    known = set([hypervisor_host(hypervisor) for hypervisor in hypervisors])
+    unknown = drain - known
+    if unknown:
+        raise ValueError("Unknown hosts: {}".format(", ".join(sorted(unknown))))
+
+    # Free capacity on each target, as [name, vcpus, ram, disk].
+    targets = []
+    for hypervisor in sorted(hypervisors, key=hypervisor_host):
+        name = hypervisor_host(hypervisor)
+        if name in drain:
+            continue
+        if hypervisor.get("state") != "up" or hypervisor.get("status") != "enabled":
+            logger.info('Skipping host "%s": %s, %s', name,
+                hypervisor.get("state"), hypervisor.get("status"))
+            continue
+
+        allocated = list(map(sum, zip([0, 0, 0],
+            *[size for server, size in servers.get(name, [])])))
+        limit = [physical * limits[resource] for physical, resource
+            in zip(hypervisor_size(hypervisor), RESOURCES)]
+        targets.append([name] + [l - a for l, a in zip(limit, allocated)])
+
+    moving = [Placement(server, size, name, None)
+        for name in drain for server, size in servers.get(name, [])]
+
+    if not targets:
+        return [], moving
+
+    # Weight each resource by the average target so that they're comparable.
+    averages = [max(float(sum(column)) / len(targets), 1)
+        for column in list(zip(*targets))[1:]]
+    def weight(placement):
+        return max([float(s) / a for s, a in zip(placement.size, averages)])
+    moving.sort(key=weight, reverse=True)
+
+    placements = []
+    unplaced = []
+    for placement in moving:
+        vcpus, ram, disk = placement.size
+        for target in targets:
+            if target[1] >= vcpus and target[2] >= ram and target[3] >= disk:
+                target[1] -= vcpus
+                target[2] -= ram
+                target[3] -= disk
+                placements.append(placement._replace(target=target[0]))
+                break
+        else:
+            unplaced.append(placement)
+
+    logger.info("Placed %d servers, %d did not fit", len(placements), len(unplaced))
+    return placements, unplaced
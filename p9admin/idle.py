@@ -0,0 +1,72 @@
+import collections
+import datetime
+import logging
+import p9admin.host
+import p9admin.trace
+
+logger = logging.getLogger(__name__)
+
+Idle = collections.namedtuple("Idle",
+    ["type", "id", "name", "project_id", "size", "unit", "idle_days"])
+
+def _parse_time(value):
+    """Parse an OpenStack timestamp into a naive UTC datetime, or None"""
+    if not value:
+        return None
+    value = value.rstrip("Z").split("+")[0]
+    for format in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+    logger.warning('Could not parse time "%s"', value)
+    return None
+
+def _idle_days(resource, now):
+    updated = _parse_time(resource.updated_at)
+    if updated is None:
+        return None
+    return (now - updated).days
+
+@p9admin.trace.traced
+def find_idle(client, days):
+    """
+    Find resources that are using capacity without doing anything
+
+    Returns a dict with lists of Idle for "server" (shut off for at least days
+    days), "volume" (available, i.e. not attached, for at least days days), and
+    "floating_ip" (not associated with a port), each sorted largest first.
+    Times are based on when the resource was last updated.
+    """
+    now = datetime.datetime.utcnow()
+    idle = {"server": [], "volume": [], "floating_ip": []}
+
+    for server in client.all_servers():
+        if server.status != "SHUTOFF":
+            continue
+        idle_days = _idle_days(server, now)
+        if idle_days is not None and idle_days >= days:
+            vcpus, ram, disk = p9admin.host.server_size(client, server)
+            idle["server"].append(Idle("server", server.id, server.name,
+                server.project_id, ram, "MB RAM", idle_days))
+
+    for volume in client.all_volumes():
+        if volume.status != "available":
+            continue
+        idle_days = _idle_days(volume, now)
+        if idle_days is not None and idle_days >= days:
+            idle["volume"].append(Idle("volume", volume.id, volume.name,
+                volume.project_id, volume.size, "GB", idle_days))
+
+    if client.has_service("network"):
+        for ip in client.network_list("floatingips", ("id",
+                "floating_ip_address", "project_id", "port_id", "updated_at")):
+            if not ip.port_id:
+                idle["floating_ip"].append(Idle("floating_ip", ip.id,
+                    ip.floating_ip_address, ip.project_id, 1, "IP",
+                    _idle_days(ip, now)))
+
+    for items in idle.values():
+        items.sort(key=lambda item: (item.size, item.idle_days or 0), reverse=True)
+
+    return idle
@@ -0,0 +1,327 @@
+import collections
+import configparser
+import hashlib
+import logging
+import p9admin.trace
+
+logger = logging.getLogger(__name__)
+
+ImageInfo = collections.namedtuple("ImageInfo",
+    ["id", "name", "owner", "size", "checksum", "status"])
+
+class ImageIndex(object):
+    """
+    Index of Glance images by content, owner and size
+
+    Images are added one at a time so that the index can be built while
+    streaming the image listing.
+    """
+
+    def __init__(self):
+        self.images = {}
+        # (checksum, size) -> [ImageInfo]
+        self.by_content = collections.defaultdict(list)
+        self.by_owner = collections.defaultdict(list)
+        self.total_size = 0
+
+    def add(self, image):
+        info = ImageInfo(
+            image["id"],
+            image.get("name"),
+            image.get("owner"),
+            image.get("size") or 0,
+            image.get("checksum"),
+            image.get("status"))
+
+        self.images[info.id] = info
+        self.by_owner[info.owner].append(info)
+        self.total_size += info.size
+        if info.checksum:
+            self.by_content[(info.checksum, info.size)].append(info)
+        return info
+
+    def duplicates(self):
+        """
+        Get groups of images with the same contents
+
+        Returns a list of (reclaimable_bytes, [ImageInfo]) tuples, largest
+        first. Reclaimable bytes assumes all but one copy could be removed.
+        """
+        groups = []
+        for (checksum, size), images in self.by_content.items():
+            if len(images) > 1:
+                groups.append((size * (len(images) - 1), images))
+        groups.sort(key=lambda group: group[0], reverse=True)
+        return groups
+
+    def unowned(self, project_ids=None):
+        """
+        Get images with no owner
+
+        If project_ids is passed, images owned by a project that isn't in it
+        are included too.
+        """
+        unowned = []
+        for owner, images in self.by_owner.items():
+            if not owner or (project_ids is not None and owner not in project_ids):
+                unowned.extend(images)
+        return unowned
+
+def index_images(images):
+    """Build an ImageIndex in a single pass over an image listing"""
+    index = ImageIndex()
+    for image in images:
+        index.add(image)
+    logger.info("Indexed %d images (%d bytes)", len(index.images), index.total_size)
+    return index
+
+Consumer = collections.namedtuple("Consumer", ["type", "id", "name", "project_id"])
+
+class ImageUsage(object):
+    """
+    Index of the servers and volumes created from each image
+
+    consumers maps image ID -> [Consumer]. Consumers whose image isn't in the
+    ImageIndex (e.g. it has been deleted) are included too.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.consumers = collections.defaultdict(list)
+
+    def add(self, image_id, consumer):
+        if image_id:
+            self.consumers[image_id].append(consumer)
+
+    def unused(self):
+        """Get images with no consumers, largest first"""
+        unused = [info for id, info in self.index.images.items()
+            if id not in self.consumers]
+        unused.sort(key=lambda info: info.size, reverse=True)
+        return unused
+
+    def most_used(self, count=None):
+        """Get (image ID, [Consumer]) for the most used images, most first"""
+        used = sorted(self.consumers.items(),
+            key=lambda item: len(item[1]), reverse=True)
+        return used[:count]
+
+    def missing(self):
+        """Get IDs of images that are used but not in the index"""
+        return [id for id in self.consumers if id not in self.index.images]
+
+@p9admin.trace.traced
+def image_usage(client, index):
+    """
+    Build an ImageUsage from one listing each of servers and volumes
+
+    Servers booted from volume have no image of their own; their volume
+    records the image it was created from instead.
+    """
+    usage = ImageUsage(index)
+
+    for server in client.all_servers():
+        image = server.image or {}
+        usage.add(image.get("id"), Consumer("server", server.id, server.name,
+            server.project_id))
+
+    for volume in client.all_volumes():
+        metadata = volume.volume_image_metadata or {}
+        usage.add(metadata.get("image_id"), Consumer("volume", volume.id,
+            volume.name, volume.project_id))
+
+    logger.info("Found %d images in use", len(usage.consumers))
+    return usage
+
+LocationRule = collections.namedtuple("LocationRule",
+    ["name", "location", "provider_location"])
+
+DEFAULT_LOCATION_RULES = [
+    LocationRule("imagelibrary-opdx",
+        "file:///var/opt/pf9/imagelibrary/data/",
+        "nfs://tintri-data-opdx-1-1.ops.puppetlabs.net:/tintri/p9openstack-prod/images/"),
+]
+
+def load_location_rules(path="conf/locations.ini"):
+    """
+    Load location rewrite rules from an INI file
+
+    Each section is a rule with location and provider_location prefixes.
+    Falls back to DEFAULT_LOCATION_RULES if the file is missing or empty.
+    """
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(path)
+
+    rules = []
+    for name in config.sections():
+        try:
+            rules.append(LocationRule(name,
+                config[name]["location"], config[name]["provider_location"]))
+        except KeyError as e:
+            logger.error('Skipping rule "%s" in %s: missing %s', name, path, e)
+
+    if not rules:
+        logger.info("No location rules found in %s; using defaults", path)
+        return DEFAULT_LOCATION_RULES
+
+    return rules
+
+class LocationRules(object):
+    """
+    Location rewrite rules compiled into a prefix trie
+
+    Matching a location costs one step per character of the location no matter
+    how many rules there are. The longest matching prefix wins.
+    """
+
+    def __init__(self, rules):
+        self.root = {}
+        for rule in rules:
+            node = self.root
+            for char in rule.location:
+                node = node.setdefault(char, {})
+            if None in node:
+                logger.warning('Rule "%s" has the same location as rule "%s"',
+                    rule.name, node[None].name)
+            # None can't collide with a character key.
+            node[None] = rule
+
+    def match(self, location):
+        """Return the rule with the longest prefix of location, or None"""
+        node = self.root
+        match = node.get(None)
+        for char in location:
+            node = node.get(char)
+            if node is None:
+                break
+            match = node.get(None, match)
+        return match
+
+    def rewrite(self, location):
+        """Return (rule, provider_location), or (None, None) if nothing matches"""
+        rule = self.match(location)
+        if rule is None:
+            return None, None
+        return rule, rule.provider_location + location[len(rule.location):]
+
+# Property set on copies so that an interrupted copy can be found and resumed.
+COPIED_FROM_PROPERTY = "p9admin_copied_from"
+
+# Core properties to carry over to a copy.
+COPY_PROPERTIES = ("disk_format", "container_format", "min_disk", "min_ram",
+    "os_distro", "os_version", "architecture", "hw_disk_bus", "hw_scsi_model",
+    "hw_qemu_guest_agent")
+
+class ChecksumReader(object):
+    """
+    File-like wrapper around an iterable of chunks that hashes as it's read
+
+    Only one chunk is held in memory at a time. When the source is exhausted
+    the MD5 of everything read is compared to expected_checksum, and IOError
+    is raised on a mismatch so that the upload reading from this fails.
+    """
+
+    def __init__(self, chunks, expected_checksum=None):
+        self.chunks = iter(chunks)
+        self.expected_checksum = expected_checksum
+        self.md5 = hashlib.md5()
+        self.buffer = b""
+        self.bytes = 0
+        self.finished = False
+
+    def read(self, size=-1):
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self._finish()
+                break
+            self.md5.update(chunk)
+            self.bytes += len(chunk)
+            self.buffer += chunk
+
+        if size < 0:
+            data, self.buffer = self.buffer, b""
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def _finish(self):
+        self.finished = True
+        checksum = self.md5.hexdigest()
+        if self.expected_checksum and checksum != self.expected_checksum:
+            raise IOError("Checksum mismatch after {} bytes: expected {}, got {}"
+                .format(self.bytes, self.expected_checksum, checksum))
+
+def _find_copy(glance, source, owner):
+    """Find a copy of source left by an earlier run, if any"""
+    filters = {COPIED_FROM_PROPERTY: source.id}
+    if owner:
+        filters["owner"] = owner
+    for image in glance.images.list(filters=filters):
+        return image
+    return None
+
+@p9admin.trace.traced
+def copy_image(source_glance, dest_glance, image_id, owner=None, name=None):
+    """
+    Copy an image, streaming its data from one Glance to another
+
+    The data is never written to disk and at most a chunk or two is held in
+    memory. Its checksum is verified as it streams and again once Glance has
+    stored it.
+
+    Copies are tagged with the source image ID. If a previous copy was
+    interrupted, it is reused (or replaced if Glance left it unusable) rather
+    than creating another image, and a completed copy is not copied again.
+    Glance can't append to a partial upload, so resuming restarts the data
+    transfer from the beginning.
+
+    The copy is owned by owner, or by the source image's owner if owner is
+    None.
+
+    Returns the destination image.
+    """
+    source = source_glance.images.get(image_id)
+    if source.status != "active":
+        raise ValueError('Image "{}" [{}] is {}, not active'.format(
+            source.name, source.id, source.status))
+
+    if owner is None:
+        owner = source.get("owner")
+
+    dest = _find_copy(dest_glance, source, owner)
+    if dest is not None:
+        if dest.status == "active" and dest.checksum == source.checksum:
+            logger.info('Image "%s" [%s] was already copied to [%s]',
+                source.name, source.id, dest.id)
+            return dest
+        if dest.status != "queued":
+            logger.info('Deleting %s copy [%s] of image [%s]',
+                dest.status, dest.id, source.id)
+            dest_glance.images.delete(dest.id)
+            dest = None
+        else:
+            logger.info('Resuming copy [%s] of image [%s]', dest.id, source.id)
+
+    if dest is None:
+        properties = dict((key, source[key]) for key in COPY_PROPERTIES
+            if source.get(key) is not None)
+        properties[COPIED_FROM_PROPERTY] = source.id
+        if owner:
+            properties["owner"] = owner
+        dest = dest_glance.images.create(name=name or source.name, **properties)
+        logger.info('Created image "%s" [%s]', dest.name, dest.id)
+
+    # glanceclient streams the response in small chunks.
+    reader = ChecksumReader(source_glance.images.data(source.id), source.checksum)
+    dest_glance.images.upload(dest.id, reader, image_size=source.size)
+
+    dest = dest_glance.images.get(dest.id)
+    if dest.checksum != source.checksum:
+        raise IOError("Copy [{}] has checksum {}, expected {}".format(
+            dest.id, dest.checksum, source.checksum))
+
+    logger.info('Copied %d bytes from image [%s] to [%s]',
+        reader.bytes, source.id, dest.id)
+    return dest
@@ -0,0 +1,194 @@
+import atexit
+import collections
+import keystoneauth1
+import logging
+import re
+import threading
+import time
+import p9admin.cache
+import p9admin.trace
+
+logger = logging.getLogger(__name__)
+
+# Keystone IDs are UUID4 hex strings without dashes.
+ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+INDEX_VERSION = 1
+INDEX_FILE = "index.json"
+
+Entry = collections.namedtuple("Entry", ["id", "name"])
+
+def looks_like_id(value):
+    return bool(ID_RE.match(value))
+
+class NameIndex(object):
+    """
+    Name to ID index for Keystone projects, users and roles
+
+    The index is loaded with one bulk listing per kind and saved between runs.
+    A saved index is only used if it was built against the same auth URL and
+    is younger than ttl seconds. If a name isn't found in a saved index, the
+    index is reloaded from Keystone once before giving up, so stale entries
+    can cause at most one extra round of listings per run.
+
+    Lookups return Entry(id, name) tuples, which the Keystone client accepts
+    anywhere it accepts a resource object.
+
+    The age of a saved index is the time of its last full reload; recording
+    created or deleted objects doesn't make it any younger. Changes are saved
+    once, when the process exits.
+    """
+
+    KINDS = ("projects", "users", "roles")
+
+    def __init__(self, client, auth_url, ttl=3600):
+        self.client = client
+        self.auth_url = auth_url
+        self.ttl = ttl
+        self.by_name = None
+        self.by_id = None
+        # Time of the last full reload from Keystone.
+        self.loaded_at = None
+        # Whether the index has been loaded from Keystone during this run.
+        self.fresh = False
+        self.dirty = False
+        # Guards changes to the index and the saved file.
+        self.lock = threading.RLock()
+
+        if not self._load():
+            self.refresh()
+
+        atexit.register(self.save)
+
+    def _load(self):
+        data = p9admin.cache.load_json(INDEX_FILE)
+        if not data:
+            return False
+
+        if data.get("version") != INDEX_VERSION:
+            logger.info("Ignoring saved index: wrong version")
+            return False
+        if data.get("auth_url") != self.auth_url:
+            logger.info("Ignoring saved index: built for a different cloud")
+            return False
+        age = time.time() - data.get("loaded_at", 0)
+        if age > self.ttl or age < 0:
+            logger.info("Ignoring saved index: %d seconds old", age)
+            return False
+
+        self._build(data["entries"])
+        self.loaded_at = data["loaded_at"]
+        logger.info("Loaded saved index (%d seconds old)", age)
+        return True
+
+    def _build(self, entries):
+        by_name = {}
+        by_id = {}
+        for kind in self.KINDS:
+            by_name[kind] = {}
+            by_id[kind] = {}
+            for id, name in entries.get(kind, []):
+                by_name[kind][name] = by_id[kind][id] = Entry(id, name)
+
+        # Swap in complete maps so concurrent lookups never see partial ones.
+        self.by_name, self.by_id = by_name, by_id
+
+    def _add(self, kind, entry):
+        self.by_name[kind][entry.name] = entry
+        self.by_id[kind][entry.id] = entry
+        self.dirty = True
+
+    @p9admin.trace.traced
+    def refresh(self):
+        """Reload the index from Keystone, once per run"""
+        with self.lock:
+            if self.fresh:
+                # Another thread reloaded it while this one was waiting.
+                return
+
+            keystone = self.client.keystone()
+            entries = {}
+            for kind in self.KINDS:
+                entries[kind] = [(o.id, o.name) for o in getattr(keystone, kind).list()]
+                logger.info("Indexed %d %s", len(entries[kind]), kind)
+
+            self._build(entries)
+            self.loaded_at = time.time()
+            self.fresh = True
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+
+            entries = {}
+            for kind in self.KINDS:
+                entries[kind] = [list(e) for e in self.by_id[kind].values()]
+
+            p9admin.cache.save_json(INDEX_FILE, {
+                "version": INDEX_VERSION,
+                "auth_url": self.auth_url,
+                "loaded_at": self.loaded_at,
+                "entries": entries,
+            })
+            self.dirty = False
+
+    def add(self, kind, object):
+        """Record a newly created object"""
+        with self.lock:
+            self._add(kind, Entry(object.id, object.name))
+
+    def remove(self, kind, id):
+        """Forget a deleted object"""
+        with self.lock:
+            entry = self.by_id[kind].pop(id, None)
+            if entry is not None:
+                self.by_name[kind].pop(entry.name, None)
+                self.dirty = True
+
+    def lookup(self, kind, name_or_id, by_id=True, validate=False):
+        """
+        Find an entry by name, or by ID if by_id is set
+
+        Returns None if nothing matches, even after a reload. An ID that isn't
+        in the index is fetched directly rather than reloading everything.
+
+        Set validate=True to confirm that an entry from a saved index still
+        exists in Keystone. Callers that create or delete objects need this.
+        The first validation in a run reloads the index, so validating many
+        entries costs one round of listings rather than a request each.
+        """
+        if validate and not self.fresh:
+            self.refresh()
+        entry = self._lookup(kind, name_or_id, by_id)
+        if entry is None and by_id and looks_like_id(name_or_id):
+            entry = self._get(kind, name_or_id)
+        if entry is None and not self.fresh:
+            logger.info('"%s" not found in saved index; reloading', name_or_id)
+            self.refresh()
+            entry = self._lookup(kind, name_or_id, by_id)
+        return entry
+
+    def _lookup(self, kind, name_or_id, by_id):
+        entry = self.by_name[kind].get(name_or_id)
+        if entry is None and by_id and looks_like_id(name_or_id):
+            entry = self.by_id[kind].get(name_or_id)
+        return entry
+
+    def _get(self, kind, id):
+        try:
+            object = getattr(self.client.keystone(), kind).get(id)
+        except keystoneauth1.exceptions.http.NotFound:
+            return None
+        self.add(kind, object)
+        return self.by_id[kind][id]
+
+    def project(self, name_or_id, validate=False):
+        return self.lookup("projects", name_or_id, validate=validate)
+
+    def user(self, name):
+        return self.lookup("users", name, by_id=False)
+
+    def role(self, name):
+        return self.lookup("roles", name, by_id=False)
@@ -0,0 +1,89 @@
+import atexit
+import logging
+import p9admin.cache
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+LEDGER_VERSION = 1
+LEDGER_FILE = "ledger.json"
+
+OK = "ok"
+FAILED = "failed"
+
+# Comfortably longer than the interval between nightly runs, so that
+# verification spreads out instead of expiring for everything at once.
+DEFAULT_TTL = 4 * 86400
+
+class Ledger(object):
+    """
+    Record of which projects were last fully verified, and when
+
+    Each entry records the time, whether verification succeeded, and the IDs
+    of the standard resources found or created. A project counts as verified
+    only if its last verification succeeded less than ttl seconds ago. After
+    that, the recorded IDs allow a cheap check that the resources still exist
+    before falling back to a full verification.
+
+    Changes are saved when the process exits. A run that dies partway
+    through a project never marks it verified, so the next run checks it
+    again.
+    """
+
+    def __init__(self, auth_url, ttl=DEFAULT_TTL):
+        self.auth_url = auth_url
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.dirty = False
+
+        data = p9admin.cache.load_json(LEDGER_FILE)
+        if data and data.get("version") == LEDGER_VERSION \
+                and data.get("auth_url") == auth_url:
+            self.projects = data["projects"]
+        else:
+            self.projects = {}
+
+        atexit.register(self.save)
+
+    def verified_at(self, project_id):
+        """Time of the last successful verification still within ttl, or None"""
+        entry = self.projects.get(project_id)
+        if entry is None or entry["status"] != OK:
+            return None
+        if time.time() - entry["verified_at"] > self.ttl:
+            return None
+        return entry["verified_at"]
+
+    def resources(self, project_id):
+        """IDs of the resources from the last successful verification, or None"""
+        entry = self.projects.get(project_id)
+        if entry is None or entry["status"] != OK or not entry["resources"]:
+            return None
+        return entry["resources"]
+
+    def record(self, project, status, resources=None):
+        with self.lock:
+            self.projects[project.id] = {
+                "name": project.name,
+                "status": status,
+                "verified_at": time.time(),
+                "resources": resources or {},
+            }
+            self.dirty = True
+
+    def forget(self, project_id):
+        with self.lock:
+            if self.projects.pop(project_id, None) is not None:
+                self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            p9admin.cache.save_json(LEDGER_FILE, {
+                "version": LEDGER_VERSION,
+                "auth_url": self.auth_url,
+                "projects": self.projects,
+            })
+            self.dirty = False
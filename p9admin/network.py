@@ -0,0 +1,181 @@
+import collections
+import ipaddress
+import json
+import logging
+import p9admin.trace
+import xml.etree.ElementTree as ElementTree
+
+logger = logging.getLogger(__name__)
+
+ROUTER_INTERFACE_OWNERS = ("network:router_interface",
+    "network:router_interface_distributed", "network:ha_router_replicated_interface")
+
+class Topology(object):
+    """
+    Graph of networks, subnets, routers, and ports for the whole cloud
+
+    Nodes are stored by ID in self.nodes as (type, resource). Edges are kept
+    in adjacency indexes so that queries don't need to scan everything:
+
+      subnets_by_network:  network ID -> [subnet ID]
+      router_subnets:      router ID -> set of subnet IDs it has interfaces on
+      routers_by_gateway:  network ID -> [router ID] with a gateway on it
+      by_project:          project ID -> [node ID]
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.subnets_by_network = collections.defaultdict(list)
+        self.router_subnets = collections.defaultdict(set)
+        self.routers_by_gateway = collections.defaultdict(list)
+        self.by_project = collections.defaultdict(list)
+
+    def _add_node(self, type, resource):
+        self.nodes[resource.id] = (type, resource)
+        if resource.project_id:
+            self.by_project[resource.project_id].append(resource.id)
+
+    def add_network(self, network):
+        self._add_node("network", network)
+
+    def add_subnet(self, subnet):
+        self._add_node("subnet", subnet)
+        self.subnets_by_network[subnet.network_id].append(subnet.id)
+
+    def add_router(self, router):
+        self._add_node("router", router)
+        gateway = router.external_gateway_info or {}
+        if gateway.get("network_id"):
+            self.routers_by_gateway[gateway["network_id"]].append(router.id)
+
+    def add_port(self, port):
+        self._add_node("port", port)
+        if port.device_owner in ROUTER_INTERFACE_OWNERS:
+            for ip in port.fixed_ips or []:
+                self.router_subnets[port.device_id].add(ip["subnet_id"])
+
+    def of_type(self, type):
+        return [resource for t, resource in self.nodes.values() if t == type]
+
+    def external_networks(self):
+        return [network for network in self.of_type("network")
+            if network.is_router_external]
+
+    def projects_routed_through(self, network_id):
+        """Get the IDs of projects with a router gatewayed to network_id"""
+        return sorted(set([self.nodes[router_id][1].project_id
+            for router_id in self.routers_by_gateway.get(network_id, [])]))
+
+    def routers_without_gateway(self):
+        return [router for router in self.of_type("router")
+            if not (router.external_gateway_info or {}).get("network_id")]
+
+    def overlapping_subnets(self):
+        """
+        Find subnets with overlapping CIDRs that are connected to each other
+
+        Subnets are connected if they're on the same network or attached to
+        the same router. Returns a list of (group ID, subnet, subnet) where
+        group ID is the network or router.
+        """
+        overlaps = []
+        groups = list(self.subnets_by_network.items()) \
+            + list(self.router_subnets.items())
+        for group_id, subnet_ids in groups:
+            subnets = [self.nodes[id][1] for id in subnet_ids if id in self.nodes]
+            overlaps.extend([(group_id, a, b) for a, b in _overlaps(subnets)])
+        return overlaps
+
+    def to_dict(self):
+        nodes = []
+        for id, (type, resource) in self.nodes.items():
+            nodes.append({"id": id, "type": type, "name": resource.name,
+                "project_id": resource.project_id})
+        return {"nodes": nodes, "edges": [
+            {"source": source, "target": target, "type": type}
+            for source, target, type in self.edges()]}
+
+    def edges(self):
+        for network_id, subnet_ids in self.subnets_by_network.items():
+            for subnet_id in subnet_ids:
+                yield network_id, subnet_id, "contains"
+        for router_id, subnet_ids in self.router_subnets.items():
+            for subnet_id in subnet_ids:
+                yield router_id, subnet_id, "interface"
+        for network_id, router_ids in self.routers_by_gateway.items():
+            for router_id in router_ids:
+                yield router_id, network_id, "gateway"
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def write_graphml(self, path):
+        ns = "http://graphml.graphdrawing.org/xmlns"
+        root = ElementTree.Element("graphml", xmlns=ns)
+        for key in ("type", "name", "project_id"):
+            ElementTree.SubElement(root, "key", id=key, attrib={
+                "for": "node", "attr.name": key, "attr.type": "string"})
+        ElementTree.SubElement(root, "key", id="edge_type", attrib={
+            "for": "edge", "attr.name": "type", "attr.type": "string"})
+
+        graph = ElementTree.SubElement(root, "graph", edgedefault="directed")
+        for node in self.to_dict()["nodes"]:
+            element = ElementTree.SubElement(graph, "node", id=node["id"])
+            for key in ("type", "name", "project_id"):
+                ElementTree.SubElement(element, "data", key=key).text = \
+                    str(node[key] or "")
+        for source, target, type in self.edges():
+            element = ElementTree.SubElement(graph, "edge",
+                source=source, target=target)
+            ElementTree.SubElement(element, "data", key="edge_type").text = type
+
+        ElementTree.ElementTree(root).write(path, encoding="utf-8",
+            xml_declaration=True)
+
+def _overlaps(subnets):
+    """
+    Yield pairs of subnets whose CIDRs overlap
+
+    Sorts by start address and sweeps, so it only compares subnets that
+    actually overlap instead of every pair.
+    """
+    ranges = []
+    for subnet in subnets:
+        try:
+            cidr = ipaddress.ip_network(subnet.cidr, strict=False)
+        except ValueError:
+            logger.warning('Subnet "%s" [%s] has invalid CIDR %s',
+                subnet.name, subnet.id, subnet.cidr)
+            continue
+        ranges.append((cidr.version, int(cidr.network_address),
+            int(cidr.broadcast_address), subnet))
+    ranges.sort(key=lambda r: r[:3])
+
+    active = []
+    for version, start, end, subnet in ranges:
+        active = [r for r in active if r[0] == version and r[2] >= start]
+        for other in active:
+            yield other[3], subnet
+        active.append((version, start, end, subnet))
+
+@p9admin.trace.traced
+def load_topology(client):
+    """Build a Topology with one listing each of networks, subnets, routers, and ports"""
+    topology = Topology()
+    fields = ("id", "name", "project_id")
+
+    for net in client.network_list("networks", fields + ("router:external",)):
+        topology.add_network(net)
+    for subnet in client.network_list("subnets",
+            fields + ("network_id", "cidr")):
+        topology.add_subnet(subnet)
+    for router in client.network_list("routers",
+            fields + ("external_gateway_info",)):
+        topology.add_router(router)
+    for port in client.network_list("ports",
+            fields + ("device_owner", "device_id", "fixed_ips")):
+        topology.add_port(port)
+
+    logger.info("Loaded %d networking objects", len(topology.nodes))
+    return topology
@@ -1,13 +1,17 @@
 from __future__ import print_function
 import configparser
 import json
-import keystoneauth1
 import logging
+import openstack.exceptions
 import operator
 import os
+import p9admin.client
+import p9admin.ledger
+import p9admin.trace
 import pprint
 import requests
 import sys
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -16,36 +20,89 @@ def _attrgetter(*attrs):
         return [str(getattr(object, attr)) for attr in attrs]
     return _key
 
+@p9admin.trace.traced
 def ensure_project(client, name, assume_complete=True):
     """
     Ensure that a project and the standard resources exist
 
-    By default (assume_complete=True) this does not check that the standard
-    project resources, e.g. network1, exist if the project already exists.
+    By default (assume_complete=True) this only checks that the standard
+    project resources, e.g. network1, exist if the project hasn't been fully
+    verified recently (see OpenStackClient.ledger()). If it was verified
+    longer ago, the resources recorded then are looked up by ID, and the
+    project is fully checked only if any are gone. Projects that are new or
+    failed verification are fully checked.
 
     Set assume_complete=False to ensure all of the standard project resources
-    exist even if the project itself already exists.
+    exist regardless of when they were last verified.
     """
-    # Default set up for projects
-    NETWORK_NAME = "network1"
-    SUBNET_NAME = "subnet0"
-    SUBNET_CIDR="192.168.0.0/24"
-    ROUTER_NAME = "router0"
-    SECURITY_GROUP_NAME = "default"
     DOMAIN = "default"
 
     # Create project
-    try:
-        project = client.keystone().projects.find(name=name)
+    project = client.index().lookup("projects", name, by_id=False, validate=True)
+    if project is not None:
         logger.info('Found project "%s" [%s]', project.name, project.id)
         new_project = False
         if assume_complete:
-            return project
-    except keystoneauth1.exceptions.NotFound:
+            verified_at = client.ledger().verified_at(project.id)
+            if verified_at is not None:
+                logger.info('Project "%s" [%s] was verified %d seconds ago',
+                    project.name, project.id, time.time() - verified_at)
+                return project
+
+            resources = client.ledger().resources(project.id)
+            if resources and _resources_exist(client, resources):
+                logger.info('Project "%s" [%s] resources still exist',
+                    project.name, project.id)
+                client.ledger().record(project, p9admin.ledger.OK, resources)
+                return project
+    else:
         project = client.keystone().projects.create(name=name, domain=DOMAIN)
+        client.index().add("projects", project)
         logger.info('Created project "%s" [%s]', project.name, project.id)
         new_project = True
 
+    try:
+        resources = _ensure_project_resources(client, project, new_project)
+    except Exception:
+        client.ledger().record(project, p9admin.ledger.FAILED)
+        raise
+
+    client.ledger().record(project, p9admin.ledger.OK, resources)
+    return project
+
+
+# Ledger resource names and the SDK network proxy method to get each by ID.
+RESOURCE_GETTERS = {
+    "network": "get_network",
+    "subnet": "get_subnet",
+    "router": "get_router",
+    "security_group": "get_security_group",
+    "security_group_rule": "get_security_group_rule",
+}
+
+def _resources_exist(client, resources):
+    """Check that resources recorded by the ledger still exist, by ID"""
+    network = client.openstack().network
+    for kind, getter in RESOURCE_GETTERS.items():
+        if kind not in resources:
+            return False
+        try:
+            getattr(network, getter)(resources[kind])
+        except openstack.exceptions.ResourceNotFound:
+            logger.info("%s [%s] no longer exists", kind, resources[kind])
+            return False
+    return True
+
+
+def _ensure_project_resources(client, project, new_project):
+    """Ensure the standard resources exist and return their IDs"""
+    # Default set up for projects
+    NETWORK_NAME = "network1"
+    SUBNET_NAME = "subnet0"
+    SUBNET_CIDR="192.168.0.0/24"
+    ROUTER_NAME = "router0"
+    SECURITY_GROUP_NAME = "default"
+
     # Create default network
     network = None
     if not new_project:
@@ -74,6 +131,10 @@ def ensure_project(client, name, assume_complete=True):
     if not router:
         router = client.create_router(project, network, subnet, ROUTER_NAME)
         new_router = True
+    elif not (router.external_gateway_info or {}).get("network_id"):
+        # `p9-admin network topology --no-gateway` finds these fleet-wide.
+        logger.warning('Router "%s" [%s] has no external gateway',
+            router.name, router.id)
 
     ### FIXME it seems to create the default security group automatically.
     sg = client.find_security_group(project, SECURITY_GROUP_NAME)
@@ -88,37 +149,91 @@ def ensure_project(client, name, assume_complete=True):
     if not sg_rule:
         sg_rule = client.create_security_group_rule(sg)
 
-    return project
+    return {
+        "network": network.id,
+        "subnet": subnet.id,
+        "router": router.id,
+        "security_group": sg.id,
+        "security_group_rule": sg_rule.id,
+    }
 
 
+@p9admin.trace.traced
 def get_quota(client, project_name):
+    client.require_service("quota")
     nova_url = "{}/os-quota-sets/{}".format(os.environ.get("OS_NOVA_URL"), project_name)
 
     header = {'X-AUTH-TOKEN': client.api_token(), 'Content-Type': 'application/json'}
 
-    r = requests.get(nova_url, headers=header, verify=True)
+    r = requests.get(nova_url, headers=header, verify=True,
+        hooks={"response": p9admin.trace.response_hook})
 
     return r.text
 
 
+@p9admin.trace.traced
 def apply_quota(client, project_id, quota_name, quota_value):
     """
     Apply a quota to an existing project
     """
-
+    client.require_service("quota")
     nova_url = "{}/os-quota-sets/{}".format(os.environ.get("OS_NOVA_URL"), project_id)
 
-    logger.info("About to set quota {} to {} on url {}".format(quota_name, quota_value, nova_url))
+    logger.info("About to set quota %s to %s on url %s", quota_name, quota_value, nova_url)
 
     header = {'X-AUTH-TOKEN': client.api_token(), 'Content-Type': 'application/json'}
     request_body = {"quota_set": {quota_name: quota_value}}
     data_json = json.dumps(request_body, sort_keys=True, indent=4, separators=(',', ': '))
 
-    r = requests.put(nova_url, headers=header, data=data_json, verify=True)
+    r = requests.put(nova_url, headers=header, data=data_json, verify=True,
+        hooks={"response": p9admin.trace.response_hook})
 
     return r.text
 
 
+@p9admin.trace.traced
+def get_quota_detail(client, project_id, session=None, token=None):
+    """
+    Get a project's quotas along with their usage
+
+    Returns a dict of quota name to {"limit": ..., "in_use": ...,
+    "reserved": ...}. Pass session and token to reuse them across calls.
+    """
+    client.require_service("quota")
+    nova_url = "{}/os-quota-sets/{}/detail".format(os.environ.get("OS_NOVA_URL"), project_id)
+
+    header = {'X-AUTH-TOKEN': token or client.api_token(), 'Content-Type': 'application/json'}
+
+    session = session or p9admin.client.http_session()
+    r = session.get(nova_url, headers=header, verify=True)
+    r.raise_for_status()
+
+    quotas = r.json()["quota_set"]
+    quotas.pop("id", None)
+    return quotas
+
+
+@p9admin.trace.traced
+def apply_quotas(client, project_id, quota_set, session=None, token=None):
+    """
+    Apply several quotas to an existing project in one request
+    """
+    client.require_service("quota")
+    nova_url = "{}/os-quota-sets/{}".format(os.environ.get("OS_NOVA_URL"), project_id)
+
+    logger.info("About to set quotas %s on url %s", quota_set, nova_url)
+
+    header = {'X-AUTH-TOKEN': token or client.api_token(), 'Content-Type': 'application/json'}
+    data_json = json.dumps({"quota_set": quota_set}, sort_keys=True)
+
+    session = session or p9admin.client.http_session()
+    r = session.put(nova_url, headers=header, data=data_json, verify=True)
+    r.raise_for_status()
+
+    return r.text
+
+
+@p9admin.trace.traced
 def apply_quota_defaults(client, project_id):
     """
     Apply a quota to an existing project
@@ -127,53 +242,55 @@ def apply_quota_defaults(client, project_id):
     config.read('conf/defaults.ini')
 
     for key in config["DEFAULT"]:
-        logger.debug("Applying key {} with value {}".format(key, config["DEFAULT"][key]))
+        logger.debug("Applying key %s with value %s", key, config["DEFAULT"][key])
         retval = apply_quota(client, project_id, key, config["DEFAULT"][key]) + "\n"
 
     return retval
 
 
+@p9admin.trace.traced
 def delete_project(client, name):
     ### FIXME: images?
-    project = client.find_project(name)
+    project = client.find_project(name, validate=True)
     logger.info('Started deleting project "%s" [%s]', project.name, project.id)
 
     for server in client.servers(project_id=project.id):
         client.openstack().compute.delete_server(server, force=True, ignore_missing=True)
         logger.info('  Deleted server "%s" [%s]', server.name, server.id)
 
-    try:
-        for volume in client.volumes(project_id=project.id):
-            client.openstack().block_storage.delete_volume(volume, ignore_missing=True)
-            logger.info('  Deleted volume "%s" [%s]', volume.name, volume.id)
-    except keystoneauth1.exceptions.catalog.EndpointNotFound:
-        logger.warn("No volume endpoint")
-
-    network_client = client.openstack().network
-    routers = network_client.routers(project_id=project.id)
-    for router in routers:
-        logger.info('  Started deleting router "%s" [%s]', router.name, router.id)
-        for port in network_client.ports(device_id=router.id):
-            network_client.remove_interface_from_router(router, port_id=port.id)
-            logger.info("    Removed port %s [%s]", port.device_owner, port.id)
-        network_client.delete_router(router, ignore_missing=True)
-        logger.info('    Finished deleting router')
-
-    networks = network_client.networks(project_id=project.id)
-    for network in networks:
-        logger.info('  Started deleting network "%s" [%s]', network.name, network.id)
-        subnets = client.subnets(project_id=project.id, network_id=network.id)
-        for subnet in subnets:
-            network_client.delete_subnet(subnet, ignore_missing=True)
-            logger.info('    Deleted subnet "%s" [%s]', subnet.name, subnet.id)
-        network_client.delete_network(network, ignore_missing=True)
-        logger.info('    Finished deleting network')
-
-    # The default security group is recreating when it's deleted, so we have
-    # to delete the project first.
-    security_groups = list(client.security_groups(project_id=project.id))
+    for volume in client.volumes(project_id=project.id):
+        client.openstack().block_storage.delete_volume(volume, ignore_missing=True)
+        logger.info('  Deleted volume "%s" [%s]', volume.name, volume.id)
+
+    security_groups = []
+    if client.has_service("network"):
+        network_client = client.openstack().network
+        routers = network_client.routers(project_id=project.id)
+        for router in routers:
+            logger.info('  Started deleting router "%s" [%s]', router.name, router.id)
+            for port in network_client.ports(device_id=router.id):
+                network_client.remove_interface_from_router(router, port_id=port.id)
+                logger.info("    Removed port %s [%s]", port.device_owner, port.id)
+            network_client.delete_router(router, ignore_missing=True)
+            logger.info('    Finished deleting router')
+
+        networks = network_client.networks(project_id=project.id)
+        for network in networks:
+            logger.info('  Started deleting network "%s" [%s]', network.name, network.id)
+            subnets = client.subnets(project_id=project.id, network_id=network.id)
+            for subnet in subnets:
+                network_client.delete_subnet(subnet, ignore_missing=True)
+                logger.info('    Deleted subnet "%s" [%s]', subnet.name, subnet.id)
+            network_client.delete_network(network, ignore_missing=True)
+            logger.info('    Finished deleting network')
+
+        # The default security group is recreating when it's deleted, so we have
+        # to delete the project first.
+        security_groups = list(client.security_groups(project_id=project.id))
 
     client.keystone().projects.delete(project)
+    client.index().remove("projects", project.id)
+    client.ledger().forget(project.id)
     logger.info('  Deleted project itself')
 
     for sg in security_groups:
@@ -183,11 +300,25 @@ def delete_project(client, name):
     logger.info('  Finished deleting project')
 
 
+@p9admin.trace.traced
 def show_project(client, name):
     ### FIXME: images?
     project = client.find_project(name)
     print('Project "{}" [{}]'.format(project.name, project.id))
 
+    if client.has_service("network"):
+        _show_project_network(client, project)
+
+    for volume in client.volumes(project_id=project.id):
+        print('  Volume "{}" [{}] {} GB, {}'.format(
+            volume.name, volume.id, volume.size, volume.status))
+
+    for server in client.servers(project_id=project.id):
+        print('  Server "{}" [{}] {}'.format(
+            server.name, server.id, server.status))
+
+
+def _show_project_network(client, project):
     network_client = client.openstack().network
     networks = network_client.networks(project_id=project.id)
     for network in networks:
@@ -214,17 +345,6 @@ def show_project(client, name):
         for sg_rule in sorted(sg_rules, key=sort_key_func):
             print_security_group_rule(client, sg_rule)
 
-    try:
-        for volume in client.volumes(project_id=project.id):
-            print('  Volume "{}" [{}] {} GB, {}'.format(
-                volume.name, volume.id, volume.size, volume.status))
-    except keystoneauth1.exceptions.catalog.EndpointNotFound:
-        logger.warn("No volume endpoint")
-
-    for server in client.servers(project_id=project.id):
-        print('  Server "{}" [{}] {}'.format(
-            server.name, server.id, server.status))
-
 
 def print_fixed_ips(client, fixed_ips):
     for ip in fixed_ips:
@@ -263,6 +383,7 @@ def print_security_group_rule(client, rule):
         port_range))
 
 
+@p9admin.trace.traced
 def get_stats(client, project):
     """
     Get statistics about a project
@@ -282,44 +403,43 @@ def get_stats(client, project):
         servers.append([1, count_powered])
 
     volumes = [[0, 0, 0, 0]]
-    try:
-        for volume in client.volumes(project_id=project.id):
-            if volume.status == "in-use":
-                size_inuse = volume.size
-                count_inuse = 1
-            else:
-                size_inuse = 0
-                count_inuse = 0
-
-            volumes.append((1, volume.size, count_inuse, size_inuse))
-    except keystoneauth1.exceptions.catalog.EndpointNotFound:
-        logger.warn("No volume endpoint")
+    for volume in client.volumes(project_id=project.id):
+        if volume.status == "in-use":
+            size_inuse = volume.size
+            count_inuse = 1
+        else:
+            size_inuse = 0
+            count_inuse = 0
+
+        volumes.append((1, volume.size, count_inuse, size_inuse))
 
     return list(map(sum, zip(*servers))) + list(map(sum, zip(*volumes)))
 
 
+@p9admin.trace.traced
 def verified_apply_quota_defaults(client, project):
     """ Apply defaults quotas, verifying that the quota won't be lowered first """
     config = configparser.ConfigParser()
     config.read('conf/defaults.ini')
 
     for key in config["DEFAULT"]:
-        logger.debug("Applying key {} with value {} to project {}".format(key, config["DEFAULT"][key], project.name))
+        logger.debug("Applying key %s with value %s to project %s", key, config["DEFAULT"][key], project.name)
         verified_apply_quota(client, project, key, config["DEFAULT"][key])
 
 
+@p9admin.trace.traced
 def verified_apply_quota(client, project, quota_name, quota_value, force=False):
-    quota = get_quota(client, project.id)
-    if int(quota_value) == int(json.loads(quota)["quota_set"][quota_name]):
-        logger.info("Quota already set for project {}".format(project.name))
+    current = int(json.loads(get_quota(client, project.id))["quota_set"][quota_name])
+    if int(quota_value) == current:
+        logger.info("Quota already set for project %s", project.name)
         return
 
-    if int(json.loads(quota)["quota_set"][quota_name]) == -1:
-        logger.info("Quota for project {} set to unlimited, use apply-quota to lower")
+    if current == -1:
+        logger.info("Quota for project %s set to unlimited, use apply-quota to lower", project.name)
         return
 
-    if int(quota_value) > int(json.loads(quota)["quota_set"][quota_name]):
-        logger.info("Increasing quota {} from {} to {} on project {}".format(quota_name, json.loads(quota)["quota_set"][quota_name], quota_value, project.name))
+    if int(quota_value) > current:
+        logger.info("Increasing quota %s from %s to %s on project %s", quota_name, current, quota_value, project.name)
         apply_quota(client, project.id, quota_name, quota_value)
     else:
         logger.info("Application quota larger than new quota, use apply-quota to set lower.")
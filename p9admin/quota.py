@@ -0,0 +1,130 @@
+import collections
+import concurrent.futures
+import configparser
+import logging
+import math
+import p9admin.client
+import p9admin.project
+import p9admin.trace
+import sys
+
+logger = logging.getLogger(__name__)
+
+Policy = collections.namedtuple("Policy", ["headroom", "floor", "ceiling"])
+
+# A recommended change to one quota of one project.
+QuotaChange = collections.namedtuple("QuotaChange",
+    ["resource", "in_use", "limit", "recommended"])
+
+def load_policies(path="conf/autotune.ini", headroom=None):
+    """
+    Load autotune policies from an INI file
+
+    Each section is a quota to tune, with headroom, floor, and ceiling options
+    that default to the DEFAULT section. Passing headroom overrides it for all
+    quotas. Returns a dict of quota name to Policy.
+    """
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        sys.exit("Could not read policy file {}".format(path))
+
+    policies = {}
+    for name in config.sections():
+        section = config[name]
+        policies[name] = Policy(
+            headroom if headroom is not None else section.getfloat("headroom"),
+            section.getint("floor"),
+            section.getint("ceiling"))
+    return policies
+
+def recommend(in_use, policy):
+    """Get the recommended limit for usage in_use under policy"""
+    value = int(math.ceil(in_use * (1 + policy.headroom)))
+    value = max(value, policy.floor)
+    if policy.ceiling >= 0:
+        value = min(value, policy.ceiling)
+    return max(value, in_use)
+
+def _plan_project(client, project, policies, session, token):
+    detail = p9admin.project.get_quota_detail(client, project.id,
+        session=session, token=token)
+
+    changes = []
+    for resource, policy in sorted(policies.items()):
+        if resource not in detail:
+            logger.warning('Quota "%s" not found for project "%s"',
+                resource, project.name)
+            continue
+        limit = detail[resource]["limit"]
+        in_use = detail[resource]["in_use"] + detail[resource].get("reserved", 0)
+        if limit == -1:
+            # Unlimited quotas are deliberate; leave them alone.
+            continue
+        recommended = recommend(in_use, policy)
+        if recommended != limit:
+            changes.append(QuotaChange(resource, in_use, limit, recommended))
+    return changes
+
+@p9admin.trace.traced
+def plan_autotune(client, projects, policies, workers=8):
+    """
+    Compute recommended quotas for projects
+
+    Quota details are fetched concurrently over one connection pool with one
+    token. Returns (plans, failures): plans is a list of (project,
+    [QuotaChange]) for projects with changes, and failures a list of
+    (project, exception).
+    """
+    session = p9admin.client.http_session(workers)
+    token = client.api_token()
+
+    plans = []
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(_plan_project, client, project,
+            policies, session, token), project) for project in projects)
+        for future in concurrent.futures.as_completed(futures):
+            project = futures[future]
+            try:
+                changes = future.result()
+            except Exception as e:
+                logger.error('Could not get quotas for project "%s" [%s]: %s',
+                    project.name, project.id, e)
+                failures.append((project, e))
+                continue
+            if changes:
+                plans.append((project, changes))
+
+    plans.sort(key=lambda plan: plan[0].name)
+    logger.info("%d of %d projects have quota changes", len(plans), len(projects))
+    return plans, failures
+
+@p9admin.trace.traced
+def apply_autotune(client, plans, workers=8):
+    """
+    Apply planned quota changes, one request per project
+
+    Only the changed quotas are sent. Returns a list of (project, exception)
+    for the projects that failed.
+    """
+    session = p9admin.client.http_session(workers)
+    token = client.api_token()
+
+    def apply(project, changes):
+        quota_set = dict((change.resource, change.recommended) for change in changes)
+        p9admin.project.apply_quotas(client, project.id, quota_set,
+            session=session, token=token)
+
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(apply, project, changes), project)
+            for project, changes in plans)
+        for future in concurrent.futures.as_completed(futures):
+            project = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                logger.error('Could not apply quotas to project "%s" [%s]: %s',
+                    project.name, project.id, e)
+                failures.append((project, e))
+    return failures
@@ -0,0 +1,64 @@
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+def parse_regions(ctx, param, value):
+    """Click callback to split comma-separated region options into a list"""
+    regions = []
+    for option in value or []:
+        for region in option.split(","):
+            region = region.strip()
+            if region and region not in regions:
+                regions.append(region)
+    return regions
+
+def fan_out(client, regions, func):
+    """
+    Run func against each region concurrently
+
+    func is called with an OpenStackClient for each region (sharing client's
+    session) and should return an iterable. Items are yielded as (region, item)
+    as soon as any region produces them, so total time is close to that of the
+    slowest region rather than the sum of all of them.
+
+    If func raises in any region, the exception is re-raised here once the
+    other regions have finished.
+    """
+    results = queue.Queue(maxsize=1000)
+    done = object()
+
+    def worker(region):
+        try:
+            for item in func(client.for_region(region)):
+                results.put((region, item))
+        except Exception as e:
+            logger.error('Failed in region "%s": %s', region, e)
+            results.put((region, e))
+        finally:
+            results.put((region, done))
+
+    threads = [threading.Thread(target=worker, args=(region,), name=region)
+        for region in regions]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    error = None
+    remaining = len(threads)
+    while remaining:
+        region, item = results.get()
+        if item is done:
+            remaining -= 1
+        elif isinstance(item, Exception):
+            error = error or item
+        else:
+            yield region, item
+
+    if error is not None:
+        raise error
@@ -0,0 +1,261 @@
+import collections
+import ipaddress
+import logging
+import p9admin.trace
+
+logger = logging.getLogger(__name__)
+
+# Protocols whose rules have a port range
+PORT_PROTOCOLS = ("tcp", "udp", "sctp", "udplite", "dccp")
+PROTOCOL_NAMES = {"1": "icmp", "6": "tcp", "17": "udp", "58": "ipv6-icmp",
+    "132": "sctp", "136": "udplite", "33": "dccp"}
+ALL_PORTS = (1, 65535)
+
+# A normalized rule. cidr is an ipaddress network, or None for rules with a
+# remote group. ports is (min, max): the port range for PORT_PROTOCOLS, the
+# ICMP (type, code), or (None, None) for all.
+Rule = collections.namedtuple("Rule",
+    ["direction", "ethertype", "protocol", "remote_group_id", "cidr", "ports"])
+
+def normalize(rule):
+    """
+    Convert a Neutron security group rule into a Rule
+
+    Rules with a remote address group can't be represented; check
+    has_address_group() first.
+    """
+    if has_address_group(rule):
+        raise ValueError("Rule [{}] has a remote address group".format(rule.id))
+
+    protocol = rule.protocol
+    if protocol is not None:
+        protocol = PROTOCOL_NAMES.get(str(protocol), str(protocol).lower())
+
+    if rule.remote_group_id:
+        cidr = None
+    elif rule.remote_ip_prefix:
+        cidr = ipaddress.ip_network(rule.remote_ip_prefix, strict=False)
+    elif rule.ether_type == "IPv6":
+        cidr = ipaddress.ip_network("::/0")
+    else:
+        cidr = ipaddress.ip_network("0.0.0.0/0")
+
+    ports = (rule.port_range_min, rule.port_range_max)
+    if protocol in PORT_PROTOCOLS:
+        if ports[0] is None:
+            ports = ALL_PORTS
+        elif ports[1] is None:
+            ports = (ports[0], ports[0])
+
+    return Rule(rule.direction, rule.ether_type, protocol,
+        rule.remote_group_id, cidr, ports)
+
+def has_address_group(rule):
+    """Whether a Neutron rule's remote is an address group rather than a CIDR"""
+    return bool(getattr(rule, "remote_address_group_id", None))
+
+def to_attributes(rule):
+    """Convert a Rule into keyword arguments for create_security_group_rule"""
+    ports = rule.ports
+    if rule.protocol in PORT_PROTOCOLS and ports == ALL_PORTS:
+        ports = (None, None)
+
+    attributes = {
+        "direction": rule.direction,
+        "ethertype": rule.ethertype,
+        "protocol": rule.protocol,
+        "port_range_min": ports[0],
+        "port_range_max": ports[1],
+    }
+    if rule.remote_group_id:
+        attributes["remote_group_id"] = rule.remote_group_id
+    else:
+        attributes["remote_ip_prefix"] = str(rule.cidr)
+    return attributes
+
+def _contains(outer, inner):
+    """Whether Rule outer allows everything that inner does"""
+    if outer.cidr is not None and inner.cidr is not None:
+        if not inner.cidr.subnet_of(outer.cidr):
+            return False
+    elif outer.cidr != inner.cidr:
+        return False
+
+    if outer.ports == inner.ports or outer.ports == (None, None):
+        return True
+    if inner.protocol in PORT_PROTOCOLS:
+        return outer.ports[0] <= inner.ports[0] and inner.ports[1] <= outer.ports[1]
+    return False
+
+def _collapse_cidrs(rules):
+    """Merge CIDRs of rules with the same ports"""
+    by_ports = collections.defaultdict(list)
+    for rule in rules:
+        by_ports[rule.ports].append(rule)
+
+    merged = []
+    for ports, group in by_ports.items():
+        cidrs = [rule.cidr for rule in group if rule.cidr is not None]
+        if cidrs:
+            for cidr in ipaddress.collapse_addresses(cidrs):
+                merged.append(group[0]._replace(cidr=cidr))
+        if len(cidrs) < len(group):
+            merged.append(group[0]._replace(cidr=None))
+    return merged
+
+def _merge_ports(rules):
+    """Merge overlapping and adjacent port ranges of rules with the same CIDR"""
+    if not rules or rules[0].protocol not in PORT_PROTOCOLS:
+        return rules
+
+    by_cidr = collections.defaultdict(list)
+    for rule in rules:
+        by_cidr[rule.cidr].append(rule)
+
+    merged = []
+    for cidr, group in by_cidr.items():
+        ranges = sorted([rule.ports for rule in group])
+        current = list(ranges[0])
+        for low, high in ranges[1:]:
+            if low <= current[1] + 1:
+                current[1] = max(current[1], high)
+            else:
+                merged.append(group[0]._replace(ports=tuple(current)))
+                current = [low, high]
+        merged.append(group[0]._replace(ports=tuple(current)))
+    return merged
+
+def _drop_shadowed(rules):
+    """Remove rules allowed entirely by another rule"""
+    # Broadest first, so each rule only needs checking against kept rules.
+    def breadth(rule):
+        size = rule.cidr.num_addresses if rule.cidr is not None else 0
+        if rule.ports == (None, None):
+            span = 1 << 17
+        elif rule.protocol in PORT_PROTOCOLS:
+            span = rule.ports[1] - rule.ports[0]
+        else:
+            span = 0
+        return (size, span)
+
+    kept = []
+    for rule in sorted(rules, key=breadth, reverse=True):
+        if not any(_contains(other, rule) for other in kept):
+            kept.append(rule)
+    return kept
+
+def compact_rules(rules):
+    """
+    Find a smaller set of Rules that allows exactly the same traffic
+
+    Rules are only merged with others that have the same direction, ethertype,
+    protocol, and remote group. Within those, CIDRs with the same ports are
+    collapsed, port ranges with the same CIDR are merged, and rules contained
+    in another rule are dropped, until nothing changes.
+    """
+    by_key = collections.defaultdict(set)
+    for rule in rules:
+        by_key[rule[:4]].add(rule)
+
+    compacted = []
+    for key, group in by_key.items():
+        group = list(group)
+        while True:
+            before = set(group)
+            group = _drop_shadowed(_merge_ports(_collapse_cidrs(group)))
+            if set(group) == before:
+                break
+        compacted.extend(group)
+
+    return sorted(compacted, key=str)
+
+Compaction = collections.namedtuple("Compaction",
+    ["security_group", "existing", "compacted", "to_create", "to_delete"])
+
+@p9admin.trace.traced
+def plan_compaction(client, project_ids=None):
+    """
+    Compute compacted rules for every security group
+
+    All security groups and all rules are each listed once. Pass project_ids
+    to limit it to those projects. Returns a list of Compaction for the groups
+    that can be made smaller. to_delete holds the Neutron rule objects to
+    remove and to_create the Rules to add.
+
+    Groups with any rule whose remote is an address group are left alone:
+    such a rule has no CIDR, and treating it as allowing everything would
+    change the traffic the group allows.
+    """
+    groups = {}
+    for sg in client.network_list("security_groups",
+            ("id", "name", "project_id")):
+        if project_ids is None or sg.project_id in project_ids:
+            groups[sg.id] = sg
+
+    rules = collections.defaultdict(list)
+    for rule in client.network_list("security_group_rules", ("id",
+            "security_group_id", "direction", "ethertype", "protocol",
+            "port_range_min", "port_range_max", "remote_ip_prefix",
+            "remote_group_id", "remote_address_group_id")):
+        if rule.security_group_id in groups:
+            rules[rule.security_group_id].append(rule)
+
+    compactions = []
+    for sg_id, existing in rules.items():
+        if any(has_address_group(rule) for rule in existing):
+            sg = groups[sg_id]
+            logger.info('Skipping security group "%s" [%s]: it has rules with '
+                'a remote address group', sg.name, sg.id)
+            continue
+
+        normalized = dict((rule.id, normalize(rule)) for rule in existing)
+        compacted = compact_rules(normalized.values())
+        if len(compacted) >= len(existing):
+            continue
+
+        # Keep one existing rule for each compacted rule it matches exactly.
+        keep = set(compacted)
+        to_delete = []
+        for rule in existing:
+            if normalized[rule.id] in keep:
+                keep.remove(normalized[rule.id])
+            else:
+                to_delete.append(rule)
+        present = set(normalized.values())
+        to_create = [rule for rule in compacted if rule not in present]
+        compactions.append(Compaction(groups[sg_id], existing, compacted,
+            to_create, to_delete))
+
+    logger.info("%d of %d security groups can be compacted",
+        len(compactions), len(groups))
+    return compactions
+
+@p9admin.trace.traced
+def apply_compaction(client, compaction):
+    """
+    Replace a security group's rules with the compacted set
+
+    New rules are created before old ones are deleted, so the group allows
+    the same traffic throughout. If any creation fails, the rules created so
+    far are removed and the group is left as it was.
+    """
+    network = client.openstack().network
+    sg = compaction.security_group
+
+    created = []
+    try:
+        for rule in compaction.to_create:
+            created.append(network.create_security_group_rule(
+                security_group_id=sg.id, **to_attributes(rule)))
+    except Exception:
+        logger.error('Could not create rules in security group "%s" [%s]; '
+            'rolling back', sg.name, sg.id)
+        for rule in created:
+            network.delete_security_group_rule(rule, ignore_missing=True)
+        raise
+
+    for rule in compaction.to_delete:
+        network.delete_security_group_rule(rule, ignore_missing=True)
+
+    logger.info('Compacted security group "%s" [%s]: +%d -%d rules',
+        sg.name, sg.id, len(created), len(compaction.to_delete))
@@ -0,0 +1,151 @@
+import collections
+import concurrent.futures
+import keystoneauth1.exceptions
+import logging
+import p9admin.host
+import p9admin.trace
+
+logger = logging.getLogger(__name__)
+
+Orphan = collections.namedtuple("Orphan",
+    ["type", "id", "name", "project_id", "size", "resource"])
+
+# Resource types in the order they must be deleted.
+TYPES = ("server", "floating_ip", "router", "port", "volume", "network",
+    "security_group")
+
+# Units for Orphan.size, by type.
+UNITS = {
+    "server": "vCPUs",
+    "floating_ip": "IPs",
+    "router": "routers",
+    "port": "ports",
+    "volume": "GB",
+    "network": "networks",
+    "security_group": "groups",
+}
+
+def _listings(client):
+    """Yield (type, resource, size) for every resource in the cloud"""
+    for server in client.all_servers():
+        yield "server", server, p9admin.host.server_size(client, server)[0]
+    for volume in client.all_volumes():
+        yield "volume", volume, volume.size
+
+    if not client.has_service("network"):
+        return
+
+    # Only the fields needed to find and report orphans are requested.
+    fields = ("id", "name", "project_id")
+    for ip in client.network_list("floatingips",
+            ("id", "floating_ip_address", "project_id")):
+        yield "floating_ip", ip, 1
+    for router in client.network_list("routers", fields):
+        yield "router", router, 1
+    for port in client.network_list("ports", fields):
+        yield "port", port, 1
+    for net in client.network_list("networks", fields):
+        yield "network", net, 1
+    for sg in client.network_list("security_groups", fields):
+        yield "security_group", sg, 1
+
+def _project_deleted(client, project_id):
+    try:
+        client.keystone().projects.get(project_id)
+    except keystoneauth1.exceptions.NotFound:
+        return True
+    logger.warning("Project [%s] exists but was not listed; not sweeping it",
+        project_id)
+    return False
+
+@p9admin.trace.traced
+def find_orphans(client):
+    """
+    Find resources whose project no longer exists
+
+    Each resource type is listed once for the whole cloud and joined against
+    the set of project IDs from a fresh Keystone listing. Resources with no
+    project (e.g. shared infrastructure) are ignored.
+
+    Projects are listed after the resources, so a project created during the
+    listings can't make its resources look orphaned. Each missing project is
+    then checked individually and only counts as deleted if Keystone returns
+    404 for it.
+
+    Returns a dict of type to list of Orphans, largest first.
+    """
+    resources = list(_listings(client))
+
+    project_ids = set([project.id for project in client.projects()])
+    logger.info("Found %d projects", len(project_ids))
+
+    missing = set([resource.project_id for type, resource, size in resources
+        if resource.project_id and resource.project_id not in project_ids])
+    deleted = set([project_id for project_id in missing
+        if _project_deleted(client, project_id)])
+
+    orphans = dict((type, []) for type in TYPES)
+    for type, resource, size in resources:
+        if resource.project_id in deleted:
+            orphans[type].append(Orphan(type, resource.id,
+                getattr(resource, "name", None) or "", resource.project_id,
+                size or 0, resource))
+
+    for type in TYPES:
+        orphans[type].sort(key=lambda orphan: orphan.size, reverse=True)
+        logger.info("Found %d orphaned %s resources", len(orphans[type]), type)
+
+    return orphans
+
+def _delete(client, orphan):
+    compute = client.openstack().compute
+    network = client.openstack().network
+
+    if orphan.type == "server":
+        compute.delete_server(orphan.resource, force=True, ignore_missing=True)
+        # Volumes and ports can't be cleaned up until the server is gone.
+        compute.wait_for_delete(orphan.resource)
+    elif orphan.type == "floating_ip":
+        network.delete_ip(orphan.resource, ignore_missing=True)
+    elif orphan.type == "router":
+        for port in network.ports(device_id=orphan.id,
+                device_owner="network:router_interface"):
+            network.remove_interface_from_router(orphan.resource, port_id=port.id)
+        network.delete_router(orphan.resource, ignore_missing=True)
+    elif orphan.type == "port":
+        network.delete_port(orphan.resource, ignore_missing=True)
+    elif orphan.type == "volume":
+        client.openstack().block_storage.delete_volume(orphan.resource,
+            ignore_missing=True)
+    elif orphan.type == "network":
+        network.delete_network(orphan.resource, ignore_missing=True)
+    elif orphan.type == "security_group":
+        network.delete_security_group(orphan.resource, ignore_missing=True)
+    else:
+        raise ValueError("Unknown resource type {}".format(orphan.type))
+
+    logger.info('Deleted %s "%s" [%s] from project [%s]',
+        orphan.type, orphan.name, orphan.id, orphan.project_id)
+
+@p9admin.trace.traced
+def delete_orphans(client, orphans, workers=8):
+    """
+    Delete orphans, one type at a time in dependency order
+
+    Resources of the same type are deleted in parallel. Returns a list of
+    (Orphan, exception) for the deletions that failed.
+    """
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for type in TYPES:
+            futures = dict((executor.submit(_delete, client, orphan), orphan)
+                for orphan in orphans.get(type, []))
+            for future in concurrent.futures.as_completed(futures):
+                orphan = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error('Could not delete %s "%s" [%s]: %s',
+                        orphan.type, orphan.name, orphan.id, e)
+                    failures.append((orphan, e))
+    return failures
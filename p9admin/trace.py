@@ -0,0 +1,100 @@
+"""
+Record timelines in Chrome trace event format
+
+Traces can be opened in chrome://tracing or https://ui.perfetto.dev. Nothing is
+recorded unless enable() has been called, so spans are cheap when tracing is
+off.
+"""
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+_events = None
+_lock = threading.Lock()
+_threads = set()
+
+def enable():
+    global _events
+    _events = []
+
+def enabled():
+    return _events is not None
+
+def _microseconds(seconds):
+    return int(seconds * 1000000)
+
+def record(name, category, start, duration, **args):
+    """Record a completed span that started at time.time() start"""
+    if _events is None:
+        return
+
+    thread = threading.current_thread()
+    tid = thread.ident
+    with _lock:
+        if tid not in _threads:
+            _threads.add(tid)
+            _events.append({
+                "ph": "M", "name": "thread_name", "pid": os.getpid(),
+                "tid": tid, "args": {"name": thread.name},
+            })
+        _events.append({
+            "ph": "X",
+            "name": name,
+            "cat": category,
+            "ts": _microseconds(start),
+            "dur": _microseconds(duration),
+            "pid": os.getpid(),
+            "tid": tid,
+            "args": args,
+        })
+
+@contextlib.contextmanager
+def span(name, category="p9admin", **args):
+    """Record the time spent in a with block"""
+    if _events is None:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, category, start, time.time() - start, **args)
+
+def traced(func):
+    """Decorator to record a span for each call of a function"""
+    name = "{}.{}".format(func.__module__, getattr(func, "__qualname__", func.__name__))
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _events is None:
+            return func(*args, **kwargs)
+        with span(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+def response_hook(response, *args, **kwargs):
+    """requests response hook to record each HTTP request as a span"""
+    if _events is None:
+        return
+
+    duration = response.elapsed.total_seconds()
+    url = urlsplit(response.request.url)
+    record("{} {}{}".format(response.request.method, url.netloc, url.path),
+        "http", time.time() - duration, duration,
+        status=response.status_code, url=response.request.url)
+
+def write(path):
+    with _lock:
+        events = list(_events or [])
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
@@ -1,6 +1,11 @@
+import collections
+import concurrent.futures
+import csv
 import logging
 import p9admin
+import p9admin.trace
 import sys
+import time
 
 class User(object):
     def __init__(self, name, email, group=None, number=None):
@@ -42,19 +47,165 @@ def load_users(p9Users, client):
 
     return users
 
-def get_ldap_group_users(name, uid, password):
+Grant = collections.namedtuple("Grant", ["email", "project", "role", "action"])
+
+def load_grants(path):
+    """
+    Read a grant manifest
+
+    Each row is: email, project, role, action. Role defaults to "_member_" and
+    action (grant or revoke) defaults to grant. A header row is optional.
+    """
+    grants = []
+    with open(path) as f:
+        for number, row in enumerate(csv.reader(f), start=1):
+            row = [field.strip() for field in row]
+            if not row or row[0].startswith("#"):
+                continue
+            if number == 1 and row[0] == "email":
+                continue
+            if len(row) < 2 or len(row) > 4:
+                sys.exit("{}:{}: expected email, project, role, action".format(
+                    path, number))
+
+            row += [""] * (4 - len(row))
+            email, project, role, action = row
+            action = action.lower() or "grant"
+            if action not in ("grant", "revoke"):
+                sys.exit('{}:{}: action must be grant or revoke, not "{}"'.format(
+                    path, number, action))
+
+            grants.append(Grant(email, project, role or "_member_", action))
+
+    return grants
+
+@p9admin.trace.traced
+def apply_grants(client, grants, workers=8):
+    """
+    Make role assignments match a list of Grants
+
+    Names are resolved through the client index and compared against a single
+    listing of all role assignments, so only grants and revokes that actually
+    change something are sent. Those are run concurrently.
+
+    Returns (changes, unchanged, failures, seconds) where changes and failures
+    are lists of Grants.
+    """
+    logger = logging.getLogger(__name__)
+    start = time.time()
+    index = client.index()
+
+    missing = set()
+    resolved = {}
+    for grant in grants:
+        user = index.user(grant.email)
+        project = index.project(grant.project)
+        role = index.role(grant.role)
+        if user is None:
+            missing.add('user "{}"'.format(grant.email))
+        if project is None:
+            missing.add('project "{}"'.format(grant.project))
+        if role is None:
+            missing.add('role "{}"'.format(grant.role))
+        if user and project and role:
+            key = (user.id, project.id, role.id)
+            if key in resolved and resolved[key][0].action != grant.action:
+                sys.exit("Conflicting actions for {} on {} with {}".format(
+                    grant.email, grant.project, grant.role))
+            resolved[key] = (grant, user, project, role)
+
+    if missing:
+        sys.exit("Could not find: {}".format(", ".join(sorted(missing))))
+
+    existing = set()
+    for assignment in client.keystone().role_assignments.list():
+        try:
+            existing.add((assignment.user["id"],
+                assignment.scope["project"]["id"],
+                assignment.role["id"]))
+        except (AttributeError, KeyError):
+            # Group or domain assignment
+            pass
+    logger.info("Retrieved %d user role assignments", len(existing))
+
+    todo = []
+    unchanged = 0
+    for key, (grant, user, project, role) in resolved.items():
+        if (key in existing) == (grant.action == "grant"):
+            unchanged += 1
+        else:
+            todo.append((grant, user, project, role))
+
+    def change(grant, user, project, role):
+        if grant.action == "grant":
+            client.keystone().roles.grant(role.id, user=user.id, project=project.id)
+        else:
+            client.keystone().roles.revoke(role.id, user=user.id, project=project.id)
+        logger.info('%s user "%s" role "%s" on project "%s"',
+            grant.action.capitalize(), user.name, role.name, project.name)
+
+    changes = []
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(change, *item): item[0] for item in todo}
+        for future in concurrent.futures.as_completed(futures):
+            grant = futures[future]
+            try:
+                future.result()
+                changes.append(grant)
+            except Exception as e:
+                logger.error("Could not %s %s on %s with %s: %s",
+                    grant.action, grant.email, grant.project, grant.role, e)
+                failures.append(grant)
+
+    return changes, unchanged, failures, time.time() - start
+
+GROUPS_DN = "ou=groups,dc=puppetlabs,dc=com"
+
+def _group_dn(name):
+    return "cn={},{}".format(name, GROUPS_DN)
+
+def _member_filter(*clauses):
     filters = [
         'objectClass=puppetPerson',
         '!(objectClass=exPuppetPerson)',
-        'memberOf=cn={},ou=groups,dc=puppetlabs,dc=com'.format(name),
-    ]
+    ] + list(clauses)
 
     filters = "".join(["({})".format(filter) for filter in filters])
-    filter = '(&{})'.format(filters)
+    return '(&{})'.format(filters)
 
+def get_ldap_group_users(name, uid, password):
+    filter = _member_filter('memberOf={}'.format(_group_dn(name)))
     return get_ldap_users(filter, uid, password)
 
+@p9admin.trace.traced
+def get_ldap_groups_users(names, uid, password):
+    """
+    Get the members of several LDAP groups with a single search
+
+    Returns a dict of group name to list of Users. A user in more than one
+    group is represented by the same User object in each list.
+    """
+    dns = dict((_group_dn(name).lower(), name) for name in names)
+    memberships = "".join(["(memberOf={})".format(_group_dn(name))
+        for name in names])
+    filter = _member_filter("|" + memberships)
+
+    groups = dict((name, []) for name in names)
+    for user, attrs in _search_ldap_users(filter, uid, password, ["memberOf"]):
+        for dn in attrs.get("memberOf", list()):
+            name = dns.get(dn.decode("utf-8").lower())
+            if name is not None:
+                groups[name].append(user)
+
+    return groups
+
+@p9admin.trace.traced
 def get_ldap_users(filter, uid, password):
+    return [user for user, attrs in _search_ldap_users(filter, uid, password)]
+
+def _search_ldap_users(filter, uid, password, extra_attrs=[]):
+    """Return a list of (User, LDAP attributes) tuples matching filter"""
     USERS_DN = "ou=users,dc=puppetlabs,dc=com"
     LDAP_URL = "ldap://ldap.puppetlabs.com"
 
@@ -70,14 +221,16 @@ def get_ldap_users(filter, uid, password):
 
     try:
         try:
-            client.simple_bind_s(bind_dn, password)
+            with p9admin.trace.span("LDAP bind", "ldap", url=LDAP_URL):
+                client.simple_bind_s(bind_dn, password)
         except ldap.LDAPError as e:
-            logger.critical("Could not bind to LDAP server '{}' as '{}': {}"
-                .format(LDAP_URL, bind_dn, e))
+            logger.critical("Could not bind to LDAP server '%s' as '%s': %s",
+                LDAP_URL, bind_dn, e)
             sys.exit(1)
 
-        users = client.search_st(USERS_DN, ldap.SCOPE_SUBTREE, filter,
-            attrlist=["cn", "mail"], timeout=60)
+        with p9admin.trace.span("LDAP search", "ldap", filter=filter):
+            users = client.search_st(USERS_DN, ldap.SCOPE_SUBTREE, filter,
+                attrlist=["cn", "mail"] + extra_attrs, timeout=60)
         if len(users) == 0:
             logger.warn('Found 0 users in LDAP for filter "%s"', filter)
             return []
@@ -106,7 +259,7 @@ def get_ldap_users(filter, uid, password):
             cn = cns[0].decode("utf-8")
             mail = mails[0].decode("utf-8")
 
-            user_objects.append(p9admin.User(cn, mail, number=count))
+            user_objects.append((p9admin.User(cn, mail, number=count), attrs))
             count += 1
 
         return user_objects
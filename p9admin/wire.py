@@ -0,0 +1,82 @@
+"""
+Count bytes received over HTTP
+
+Every session from p9admin.client.http_session() reports its responses here,
+so a command can show how much it downloaded and how much compression saved.
+
+Listings that ask for only some fields also record their size here. If
+compare_projection is set, they fetch the full listing as well so that the
+report can show what the projection saved.
+"""
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_totals = {"responses": 0, "wire": 0, "decoded": 0}
+# Listing name -> {"projected": bytes, "full": bytes}
+_listings = {}
+
+# Set to fetch full listings alongside projected ones, for the report.
+compare_projection = False
+
+# Content types whose bodies are read in the hook. Anything else (e.g. image
+# data) may be streamed, so reading it here would load it all into memory.
+COUNTED_TYPES = ("application/json",)
+
+def response_hook(response, *args, **kwargs):
+    """requests response hook to count the bytes in each response"""
+    content_type = response.headers.get("Content-Type", "")
+    if not content_type.startswith(COUNTED_TYPES):
+        return
+
+    decoded = len(response.content)
+    try:
+        # Bytes read off the socket, before decompression.
+        wire = response.raw.tell()
+    except AttributeError:
+        wire = 0
+    if not wire:
+        wire = int(response.headers.get("Content-Length") or decoded)
+
+    with _lock:
+        _totals["responses"] += 1
+        _totals["wire"] += wire
+        _totals["decoded"] += decoded
+
+def record_listing(name, projected, full=None):
+    """Record the decoded size of a projected listing, and of the full one"""
+    with _lock:
+        sizes = _listings.setdefault(name, {"projected": 0, "full": 0})
+        sizes["projected"] += projected
+        if full is not None:
+            sizes["full"] += full
+
+def totals():
+    with _lock:
+        return dict(_totals)
+
+def report():
+    """Log the bytes received so far"""
+    counts = totals()
+    if not counts["responses"]:
+        return
+    saved = 0
+    if counts["decoded"]:
+        saved = 100.0 * (counts["decoded"] - counts["wire"]) / counts["decoded"]
+    logger.info("Received %d bytes in %d JSON responses (%d uncompressed, "
+        "%.0f%% saved)", counts["wire"], counts["responses"], counts["decoded"],
+        saved)
+
+    with _lock:
+        listings = dict((name, dict(sizes)) for name, sizes in _listings.items())
+    for name, sizes in sorted(listings.items()):
+        if sizes["full"]:
+            logger.info("Listed %s: %d bytes with only needed fields, %d bytes "
+                "in full (%.0f%% saved)", name, sizes["projected"], sizes["full"],
+                100.0 * (sizes["full"] - sizes["projected"]) / sizes["full"])
+        else:
+            logger.info("Listed %s: %d bytes with only needed fields", name,
+                sizes["projected"])
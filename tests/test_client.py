@@ -0,0 +1,151 @@
+"""
+Stress tests for sharing OpenStackClient across threads
+
+The client tests run against a stand-in Keystone on localhost that only
+issues tokens, and count how many times the client authenticates.
+"""
+
+import collections
+import datetime
+import http.server
+import json
+import os
+import threading
+import time
+import unittest
+import uuid
+
+os.environ.setdefault("OS_PROJECT_NAME", "admin")
+os.environ.setdefault("OS_USERNAME", "admin")
+os.environ.setdefault("OS_PASSWORD", "secret")
+
+import p9admin.client
+
+class FakeKeystone(http.server.ThreadingHTTPServer):
+    """Keystone v3 that issues unscoped tokens slowly and counts them"""
+
+    daemon_threads = True
+
+    def __init__(self, delay=0.05):
+        super(FakeKeystone, self).__init__(("127.0.0.1", 0), TokenHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        # Number of tokens issued
+        self.tokens = 0
+
+    @property
+    def auth_url(self):
+        return "http://127.0.0.1:{}/v3".format(self.server_address[1])
+
+class TokenHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        if self.path != "/v3/auth/tokens":
+            self.send_error(404)
+            return
+
+        length = int(self.headers["Content-Length"])
+        auth = json.loads(self.rfile.read(length).decode("utf-8"))["auth"]
+        method = auth["identity"]["methods"][0]
+
+        # Widen the window for threads to race.
+        time.sleep(self.server.delay)
+        with self.server.lock:
+            self.server.tokens += 1
+
+        now = datetime.datetime.utcnow()
+        token = {
+            "methods": [method],
+            "issued_at": now.strftime("%Y-%m-%dT%H:%M:%S.000000Z"),
+            "expires_at": (now + datetime.timedelta(hours=1))
+                .strftime("%Y-%m-%dT%H:%M:%S.000000Z"),
+            "user": {"id": "admin-id", "name": "admin",
+                "domain": {"id": "default", "name": "Default"}},
+            "catalog": [],
+        }
+
+        body = json.dumps({"token": token}).encode("utf-8")
+        self.send_response(201)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Subject-Token", uuid.uuid4().hex)
+        self.end_headers()
+        self.wfile.write(body)
+
+def hammer(func, args, threads=64):
+    """Call func with each of args from many threads at once"""
+    barrier = threading.Barrier(threads)
+    results = []
+    errors = []
+
+    def run(arg):
+        barrier.wait()
+        try:
+            results.append((arg, func(arg)))
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=run, args=(args[i % len(args)],))
+        for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0]
+    return results
+
+class ConcurrentClientTest(unittest.TestCase):
+    def setUp(self):
+        self.keystone = FakeKeystone()
+        thread = threading.Thread(target=self.keystone.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.keystone.server_close)
+        self.addCleanup(self.keystone.shutdown)
+
+        self.old_auth_url = os.environ.get("OS_AUTH_URL")
+        os.environ["OS_AUTH_URL"] = self.keystone.auth_url
+        self.addCleanup(self.restore_auth_url)
+
+        self.client = p9admin.client.OpenStackClient(workers=64)
+
+    def restore_auth_url(self):
+        if self.old_auth_url is None:
+            os.environ.pop("OS_AUTH_URL", None)
+        else:
+            os.environ["OS_AUTH_URL"] = self.old_auth_url
+
+    def test_shared_session_authenticates_once(self):
+        hammer(lambda arg: self.client.session.get_token(), [None], threads=128)
+
+        self.assertEqual(self.keystone.tokens, 1)
+
+    def test_shared_service_clients_are_created_once(self):
+        results = hammer(lambda arg: self.client.keystone(), [None], threads=64)
+        self.assertEqual(len(set([id(keystone) for arg, keystone in results])), 1)
+
+class MemoizeTest(unittest.TestCase):
+    def test_memoize_computes_each_key_once(self):
+        calls = collections.Counter()
+        lock = threading.Lock()
+
+        @p9admin.client.memoize
+        def slow(key):
+            with lock:
+                calls[key] += 1
+            time.sleep(0.05)
+            return object()
+
+        keys = ["a", "b", "c", "d"]
+        results = hammer(slow, keys, threads=128)
+
+        self.assertEqual(calls, collections.Counter(dict((key, 1) for key in keys)))
+        for key in keys:
+            self.assertEqual(len(set([id(value) for arg, value in results
+                if arg == key])), 1)
+
+if __name__ == "__main__":
+    unittest.main()